@@ -18,10 +18,36 @@ class NetBoxAccessListsConfig(PluginConfig):
     default_settings = {
         'debug': False,
         'sync_interval': 3600, # 0 means disabled. Set to seconds (e.g. 3600 for 1 hour)
+        'max_workers': 8, # Concurrent Proxmox API requests while fetching VMs (1 disables concurrency)
+        'max_workers_per_node': 4, # Concurrent Proxmox API requests against a single node
+        'node_max_workers': {}, # Per-node overrides of max_workers_per_node, e.g. {'pve1': 2}
+        'node_timeout': 10, # Seconds to wait for the network interfaces of a node
+        'node_failure_threshold': 2, # Consecutive failures after which a node is skipped
+        'node_circuit_reset': 300, # Seconds a failing node is skipped before it is tried again
+        'trust_resources': False, # Take VM status from cluster/resources instead of one status/current call per VM
+        'agent_cache_ttl': 0, # Seconds to reuse guest agent network data, 0 disables the cache
+        'agent_cache_negative_ttl': None, # Seconds to remember failing/missing agents (defaults to agent_cache_ttl)
+        'agent_cache_refresh_after': 0.5, # Fraction of the TTL after which entries are refreshed in the background
+        'agent_cache_backend': None, # Django cache alias (e.g. 'default' for Redis) shared between workers
+        'fingerprint_reconcile_interval': 0, # Skip unchanged VMs/interfaces, fully comparing them every N seconds (0 = always compare)
+        'streaming': False, # Fetch, categorize and update VMs in chunks to bound memory use
+        'stream_chunk_size': 250, # VMs per chunk in streaming mode
+        'connector_backend': 'proxmoxer', # 'proxmoxer' or 'asyncio' (requires aiohttp)
+        'async_max_connections': 100, # Open connections per cluster with the 'asyncio' backend
+        'incremental': False, # Only re-read VMs/nodes touched by a task in the cluster task log since the last sync
+        'full_sync_interval': 86400, # Seconds after which an incremental sync does a full sync instead (0 = only when needed)
+        'replica_database': None, # Database alias (from DATABASES) the categorize phase reads NetBox objects from
+        'replica_max_lag': 5, # Seconds of replica lag after which reads go to the primary instead
+        'bulk_writes': False, # Create/update VMs with bulk_create/bulk_update instead of one save() per object
+        'bulk_chunk_size': 500, # Objects per bulk statement (and transaction) in bulk mode
+        'bulk_changelog': True, # Write ObjectChange records for bulk writes, in bulk
+        'node_batch_size': 10, # Nodes whose interfaces are synced per transaction
+        'ip_vrf': None, # Name of the VRF VM IP addresses are looked up and created in (None = global table)
     }
 
     def ready(self):
         super().ready()
+        from . import signals
         try:
             import datetime
             from django.conf import settings
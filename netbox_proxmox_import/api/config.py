@@ -0,0 +1,10 @@
+from django.conf import settings
+
+PLUGIN_NAME = 'netbox_proxmox_import'
+
+
+def get_plugin_setting(name, default=None):
+    try:
+        return settings.PLUGINS_CONFIG.get(PLUGIN_NAME, {}).get(name, default)
+    except Exception:
+        return default
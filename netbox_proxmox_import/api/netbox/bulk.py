@@ -0,0 +1,225 @@
+import logging
+import uuid
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from extras.models import Tag, TaggedItem
+from netbox.context import current_request
+
+try:
+    from core.choices import ObjectChangeActionChoices
+    from core.models import ObjectChange
+except ImportError:
+    # NetBox < 4.1
+    from extras.choices import ObjectChangeActionChoices
+    from extras.models import ObjectChange
+
+from ..config import get_plugin_setting
+
+logger = logging.getLogger(__name__)
+
+
+def bulk_enabled():
+    return bool(get_plugin_setting('bulk_writes', False))
+
+
+def bulk_chunk_size():
+    return max(1, int(get_plugin_setting('bulk_chunk_size', 500) or 1))
+
+
+def chunked(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def touch(instances, *field_names):
+    """
+    Run pre_save() of the given fields (auto_now timestamps, natural ordering
+    fields, ...) which bulk_update() skips, and return the names of the
+    fields it should include for them. Fields the model does not have (such
+    as _name, which newer NetBox versions replaced by a collation) are skipped.
+    """
+    if not instances:
+        return []
+    concrete = set(field.name for field in instances[0]._meta.concrete_fields)
+    fields = [instances[0]._meta.get_field(name) for name in field_names if name in concrete]
+    for instance in instances:
+        for field in fields:
+            field.pre_save(instance, False)
+    return [field.name for field in fields]
+
+
+def set_tags(tags_by_instance):
+    """
+    Make the tags of each instance exactly the given ones, with one query to
+    read the current assignments and one bulk insert/delete for the diff.
+    All instances must be of the same model.
+    """
+    if not tags_by_instance:
+        return
+    model = type(next(iter(tags_by_instance)))
+    content_type = ContentType.objects.get_for_model(model)
+    wanted = set(
+        (instance.pk, tag.pk)
+        for instance, tags in tags_by_instance.items() for tag in tags if tag is not None
+    )
+    current = {}
+    for pk, object_id, tag_id in TaggedItem.objects.filter(
+        content_type=content_type,
+        object_id__in=[instance.pk for instance in tags_by_instance],
+    ).values_list('pk', 'object_id', 'tag_id'):
+        current[(object_id, tag_id)] = pk
+
+    stale = [pk for key, pk in current.items() if key not in wanted]
+    if stale:
+        TaggedItem.objects.filter(pk__in=stale).delete()
+    TaggedItem.objects.bulk_create([
+        TaggedItem(content_type=content_type, object_id=object_id, tag_id=tag_id)
+        for object_id, tag_id in wanted - set(current)
+    ])
+    for instance, tags in tags_by_instance.items():
+        _cache_tags(instance, set(tag for tag in tags if tag is not None))
+
+
+def set_no_tags(instances):
+    """Tell instances just created in bulk that they have no tags, so
+    serializing them for the change log does not query for them one by one."""
+    for instance in instances:
+        _cache_tags(instance, [])
+
+
+def _cache_tags(instance, tags):
+    """Make instance.tags.all() return tags without a query, as a prefetch would."""
+    queryset = Tag.objects.filter(pk__in=[tag.pk for tag in tags])
+    queryset._result_cache = sorted(tags, key=lambda tag: tag.name)
+    queryset._prefetch_done = True
+    if not hasattr(instance, '_prefetched_objects_cache'):
+        instance._prefetched_objects_cache = {}
+    instance._prefetched_objects_cache['tags'] = queryset
+
+
+def refresh_counter(pks, field_name, related_model, fk_name):
+    """
+    Recount a counter cache field (e.g. Device.interface_count) of the given
+    parent objects, which bulk writes of related_model leave untouched.
+    """
+    parent_model = related_model._meta.get_field(fk_name).related_model
+    if not pks or field_name not in set(field.name for field in parent_model._meta.concrete_fields):
+        return
+    count = (
+        related_model.objects.filter(**{fk_name: OuterRef('pk')})
+        .order_by().values(fk_name).annotate(count=Count('pk')).values('count')
+    )
+    parent_model.objects.filter(pk__in=pks).update(**{field_name: Coalesce(Subquery(count), 0)})
+
+
+def cache_search(instances):
+    """Index instances written in bulk for global search, as post_save would."""
+    if not instances:
+        return
+    try:
+        from netbox.search.backends import search_backend
+        search_backend.cache(instances, remove_existing=True)
+    except Exception as e:
+        logger.warning(f"Failed to index {len(instances)} objects for search: {e}")
+
+
+def snapshot(instances):
+    """Record the pre-change state of instances about to be updated by write()."""
+    if bulk_enabled() and not get_plugin_setting('bulk_changelog', True):
+        return
+    for instance in instances:
+        instance.snapshot()
+
+
+def write(model, updated=(), fields=(), created=()):
+    """
+    Save instances of model: updated ones (changed after snapshot()) and
+    created ones. With bulk_writes, that is one bulk_update() of fields and
+    one bulk_create(), with their change log and search index written in
+    bulk too. Otherwise every instance is save()d, so the change log,
+    webhooks, event rules and receivers of other plugins see each of them.
+
+    Returns the created instances.
+    """
+    updated = list(updated)
+    created = list(created)
+    if not bulk_enabled():
+        for instance in updated + created:
+            instance.save()
+        return created
+
+    if updated:
+        model.objects.bulk_update(
+            updated, list(fields) + touch(updated, "last_updated"), batch_size=bulk_chunk_size()
+        )
+    created = model.objects.bulk_create(created, batch_size=bulk_chunk_size())
+    set_no_tags(created)
+    changelog = ChangeLog()
+    changelog.updated(updated)
+    changelog.created(created)
+    changelog.save()
+    written = updated + created
+    if written:
+        transaction.on_commit(lambda: cache_search(written))
+    return created
+
+
+class ChangeLog:
+    """
+    ObjectChange records for objects written in bulk, which bypass the
+    signals NetBox normally records changes through. Changes are attributed
+    to the user and request of the current request when there is one,
+    otherwise they share a request ID generated for the sync.
+
+    Every method is a no-op when bulk_changelog is turned off.
+    """
+
+    def __init__(self):
+        self.enabled = bool(get_plugin_setting('bulk_changelog', True))
+        request = current_request.get()
+        self.user = getattr(request, 'user', None) if request is not None else None
+        if self.user is not None and not self.user.is_authenticated:
+            self.user = None
+        self.request_id = getattr(request, 'id', None) or uuid.uuid4()
+        self.pending = []
+
+    def snapshot(self, instances):
+        """Record the pre-change state of instances about to be updated."""
+        if not self.enabled:
+            return
+        for instance in instances:
+            instance.snapshot()
+
+    def created(self, instances):
+        self._add(instances, ObjectChangeActionChoices.ACTION_CREATE)
+
+    def updated(self, instances):
+        self._add(instances, ObjectChangeActionChoices.ACTION_UPDATE)
+
+    def _add(self, instances, action):
+        if not self.enabled:
+            return
+        now = timezone.now()
+        for instance in instances:
+            change = instance.to_objectchange(action)
+            change.user = self.user
+            change.user_name = self.user.username if self.user is not None else ''
+            change.request_id = self.request_id
+            change.time = now
+            self.pending.append(change)
+
+    def save(self):
+        # Taken off the list first, so they are not saved again with the next
+        # chunk when this insert (or the transaction around it) fails
+        pending, self.pending = self.pending, []
+        if pending:
+            ObjectChange.objects.bulk_create(pending, batch_size=bulk_chunk_size())
+
+    def discard(self):
+        """Drop the pending changes, e.g. of a chunk that was rolled back."""
+        self.pending = []
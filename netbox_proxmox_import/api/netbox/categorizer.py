@@ -1,35 +1,79 @@
 import json
+from django.db.models import Q
 from extras.models import Tag
-from dcim.models import Device
+from django.contrib.contenttypes.models import ContentType
+from dcim.models import CableTermination, MACAddress
 from virtualization.models import VirtualMachine, VMInterface
-from ipam.models import VLAN
+from ipam.models import IPAddress
+
+from ..config import get_plugin_setting
+from ...models import ProxmoxObjectFingerprint, ProxmoxVMInterfaceMapping, ProxmoxVMMapping
+from .fingerprints import FingerprintStore, fingerprint
+from .database import get_read_database, on_primary
+from .indexes import DeviceIndex, VLANIndex
+from .records import Change
 
 
 class NetBoxCategorizer:
-    def __init__(self, proxmox_connection):
+    def __init__(self, proxmox_connection, device_index=None, vlan_index=None, using=None):
         self.connection = proxmox_connection
+        self._device_index = device_index
+        self._vlan_index = vlan_index
+        # Database alias NetBox objects are read from (possibly a replica).
+        # The plugin's own tables are always read from the primary, since the
+        # previous sync has just written them.
+        self.using = get_read_database() if using is None else using
+        self.vm_tag_names = {}
+        self.vm_fingerprints = None
+        self.vminterface_fingerprints = None
+        self.cabled_vminterface_ids = set()
+        self.ips_by_vminterface_id = {}
 
         self.tag_warnings = set()
         self.vm_warnings = set()
         self.vminterface_warnings = set()
 
+    @property
+    def device_index(self):
+        if self._device_index is None:
+            self._device_index = DeviceIndex(self.connection.cluster, self.using)
+        return self._device_index
+
+    @property
+    def vlan_index(self):
+        if self._vlan_index is None:
+            self._vlan_index = VLANIndex(self.connection.cluster, self.using)
+        return self._vlan_index
+
+    def _fingerprint_store(self, kind):
+        # Unchanged objects are only skipped when a reconcile interval is set
+        interval = int(get_plugin_setting('fingerprint_reconcile_interval', 0) or 0)
+        if interval <= 0:
+            return None
+        return FingerprintStore(self.connection, kind, interval)
+
     def categorize_tags(self, parsed_tags):
-        existing_tags_by_name = { tag.name: tag for tag in Tag.objects.all() }
+        # Only the tags of this cluster and the ones created by the plugin matter
+        existing_tags_by_name = {
+            tag.name: on_primary(tag) for tag in Tag.objects.using(self.using).filter(
+                Q(name__in=[tag.name for tag in parsed_tags]) | Q(slug__istartswith="nbpsync__")
+            )
+        }
 
         create = []
         update = []
         delete = []
 
         for px_tag in parsed_tags:
-            if px_tag["name"] not in existing_tags_by_name:
+            if px_tag.name not in existing_tags_by_name:
                 create.append(px_tag)
                 continue
-            nb_tag = existing_tags_by_name[px_tag["name"]]
+            nb_tag = existing_tags_by_name[px_tag.name]
             if not self._tags_equal(px_tag, nb_tag, existing_tags_by_name):
-                update.append({"before": nb_tag, "after": px_tag})
+                update.append(Change(nb_tag, px_tag))
 
         existing_tags_set = set(existing_tags_by_name.keys())
-        parsed_tags_set = set(tag["name"] for tag in parsed_tags)
+        parsed_tags_set = set(tag.name for tag in parsed_tags)
         deleted_tags_set = existing_tags_set - parsed_tags_set
         for tag_name in deleted_tags_set:
             delete.append(existing_tags_by_name[tag_name])
@@ -42,214 +86,425 @@ class NetBoxCategorizer:
         }
 
     def _tags_equal(self, px_tag, nb_tag, existing_tags_by_name={}):
-        if px_tag["slug"] != nb_tag.slug:
+        if px_tag.slug != nb_tag.slug:
             self.tag_warnings.add(
-                f"Tag '{px_tag['name']}' already exists "
+                f"Tag '{px_tag.name}' already exists "
                 f"and is not managed by this plugin!"
             )
             return True
-        return px_tag["color"] == nb_tag.color
+        return px_tag.color == nb_tag.color
 
     def categorize_nodes(self, parsed_nodes):
         # We only create/update nodes, never delete (too dangerous)
-        existing_devices = Device.objects.filter(cluster_id=self.connection.cluster.id)
-        existing_devices_by_name = {d.name: d for d in existing_devices}
+        existing_devices_by_name = self.device_index.devices_by_name
         
         create = []
         update = []
+        warnings = []
         
         for px_node in parsed_nodes:
-            if px_node["name"] not in existing_devices_by_name:
+            if px_node.network_error:
+                warnings.append(
+                    f"Network interfaces of node '{px_node.name}' could not be read "
+                    f"({px_node.network_error}), its interfaces were not synced."
+                )
+            if px_node.name not in existing_devices_by_name:
                 create.append(px_node)
             else:
-                nb_node = existing_devices_by_name[px_node["name"]]
+                nb_node = existing_devices_by_name[px_node.name]
                 # Always update to ensure interfaces are synced
-                update.append({"before": nb_node, "after": px_node})
+                update.append(Change(nb_node, px_node))
                 
         return {
             "create": create,
             "update": update,
             "delete": [],
-            "warnings": []
+            "warnings": warnings,
         }
 
     def categorize_vms(self, parsed_vms):
-        devices_by_name = {
-            device.name: device for device in Device.objects.filter(cluster_id=self.connection.cluster.id)
+        self.begin_vms()
+        categorized = self.categorize_vms_chunk(parsed_vms)
+        categorized["delete"] = self.finish_vms()
+        return categorized
+
+    def begin_vms(self):
+        """Prepare categorizing the VMs of this cluster, which can then be
+        passed to categorize_vms_chunk() in any number of chunks. Only the
+        mapping table and the IDs of the existing VMs are read here, the VMs
+        themselves are read per chunk so memory stays bounded by the chunk size."""
+        self.devices_by_name = self.device_index.devices_by_name
+        # Only VMs that existed before the first chunk can be deleted, not
+        # the ones created while writing the chunks
+        self.existing_vm_ids = set(
+            VirtualMachine.objects.using(self.using).filter(
+                cluster_id=self.connection.cluster.id
+            ).values_list('pk', flat=True)
+        )
+
+        # Create a lookup by VMID from the (indexed) mapping table
+        self.vm_mappings = {
+            vmid: (vm_id, node)
+            for vmid, vm_id, node in ProxmoxVMMapping.objects.filter(
+                connection=self.connection
+            ).values_list('vmid', 'virtual_machine_id', 'node')
         }
-        existing_vms_by_name = {
-            vm.name: vm for vm in VirtualMachine.objects.filter(cluster_id=self.connection.cluster.id)
+        self.mapped_vm_ids = set(vm_id for vm_id, _ in self.vm_mappings.values())
+
+        self.vm_tags_by_name = {
+            t.name: t for t in Tag.objects.using(self.using).filter(slug__istartswith=f"nbpsync__")
         }
-        # Create a lookup by VMID (custom field)
-        existing_vms_by_vmid = {}
-        for vm in existing_vms_by_name.values():
-            vmid = vm.custom_field_data.get("vmid")
-            if vmid:
-                existing_vms_by_vmid[vmid] = vm
 
-        tags_by_name = {
-            t.name: t for t in Tag.objects.filter(slug__istartswith=f"nbpsync__")
+        self.vm_fingerprints = self._fingerprint_store(ProxmoxObjectFingerprint.KIND_VM)
+
+        self.vm_names_to_create = set()
+        self.vm_names_to_update = set()
+        
+        # Track which existing VMs have been matched
+        self.matched_existing_vms = set()
+
+    def _load_vms(self, parsed_vms):
+        """
+        Read the existing VMs of this cluster a chunk of parsed VMs can match:
+        through the mapping of their VMIDs, by name, and (for VMs synced before
+        the mapping table existed) by VMID custom field. Everything
+        _vms_equal() compares is loaded in a constant number of queries:
+        device through a join, tags in one prefetch query and custom fields
+        are part of the VM row itself.
+        """
+        vmids = set(vm.vmid for vm in parsed_vms if vm.vmid)
+        mapped_ids = set(self.vm_mappings[vmid][0] for vmid in vmids if vmid in self.vm_mappings)
+        matches = Q(pk__in=mapped_ids) | Q(name__in=set(vm.name for vm in parsed_vms))
+        # The (unindexed) custom field is only searched for VMIDs the mapping
+        # table does not know, which after the first sync are only new VMs
+        unmapped_vmids = [vmid for vmid in vmids if vmid not in self.vm_mappings]
+        if unmapped_vmids:
+            matches |= Q(custom_field_data__vmid__in=unmapped_vmids)
+        existing_vms = [
+            on_primary(vm) for vm in VirtualMachine.objects.using(self.using).filter(
+                matches, cluster_id=self.connection.cluster.id
+            )
+            .select_related('device')
+            .prefetch_related('tags')
+        ]
+        self.existing_vms_by_name = {vm.name: vm for vm in existing_vms}
+        existing_vms_by_pk = {vm.pk: vm for vm in existing_vms}
+        self.vm_tag_names = {
+            vm.pk: set(tag.name for tag in vm.tags.all()) for vm in existing_vms
         }
 
+        self.existing_vms_by_vmid = {}
+        for vmid in vmids:
+            vm_id = self.vm_mappings.get(vmid, (None, None))[0]
+            if vm_id in existing_vms_by_pk:
+                self.existing_vms_by_vmid[vmid] = existing_vms_by_pk[vm_id]
+        # VMs not mapped yet (synced before the mapping table existed) are
+        # still found through their VMID custom field
+        for vm in existing_vms:
+            vmid = vm.custom_field_data.get("vmid")
+            if vmid and vmid not in self.existing_vms_by_vmid and vm.pk not in self.mapped_vm_ids:
+                self.existing_vms_by_vmid[vmid] = vm
+
+    def categorize_vms_chunk(self, parsed_vms):
         create = []
         update = []
-        delete = []
+        remap = []
 
-        names_to_create = set()
-        names_to_update = set()
-        
-        # Track which existing VMs have been matched
-        matched_existing_vms = set()
+        parsed_vms = list(parsed_vms)
+        self._load_vms(parsed_vms)
 
         for px_vm in parsed_vms:
             nb_vm = None
             
             # Try to match by VMID first (more reliable for renames)
-            px_vmid = px_vm["custom_fields"].get("vmid")
-            if px_vmid and px_vmid in existing_vms_by_vmid:
-                nb_vm = existing_vms_by_vmid[px_vmid]
+            px_vmid = px_vm.vmid
+            if px_vmid and px_vmid in self.existing_vms_by_vmid:
+                nb_vm = self.existing_vms_by_vmid[px_vmid]
             
             # Fallback to name match if no VMID match
-            if not nb_vm and px_vm["name"] in existing_vms_by_name:
-                nb_vm = existing_vms_by_name[px_vm["name"]]
+            if not nb_vm and px_vm.name in self.existing_vms_by_name:
+                nb_vm = self.existing_vms_by_name[px_vm.name]
 
             if not nb_vm:
-                if px_vm["name"] not in names_to_create:
-                    names_to_create.add(px_vm["name"])
+                if px_vm.name not in self.vm_names_to_create:
+                    self.vm_names_to_create.add(px_vm.name)
                     create.append(px_vm)
                     continue
             
             # Mark this existing VM as matched
-            matched_existing_vms.add(nb_vm.id)
+            self.matched_existing_vms.add(nb_vm.id)
 
-            if not self._vms_equal(px_vm, nb_vm, devices_by_name, tags_by_name):
-                if px_vm["name"] not in names_to_update:
-                    names_to_update.add(px_vm["name"])
-                    update.append({"before": nb_vm, "after": px_vm})
+            if px_vmid and self.vm_mappings.get(px_vmid) != (nb_vm.pk, px_vm.device):
+                remap.append(Change(nb_vm, px_vm))
 
-        # Delete any existing VMs that were not matched
-        for vm in existing_vms_by_name.values():
-            if vm.id not in matched_existing_vms:
-                delete.append(vm)
+            digest = fingerprint(px_vm) if self.vm_fingerprints else None
+            if digest and self.vm_fingerprints.is_unchanged(nb_vm.pk, digest):
+                continue
+
+            if not self._vms_equal(px_vm, nb_vm, self.devices_by_name, self.vm_tags_by_name):
+                if px_vm.name not in self.vm_names_to_update:
+                    self.vm_names_to_update.add(px_vm.name)
+                    update.append(Change(nb_vm, px_vm))
+            elif digest:
+                self.vm_fingerprints.mark(nb_vm.pk, digest)
 
         return {
             "create": create,
             "update": update,
-            "delete": delete,
+            "delete": [],
+            "remap": remap,
             "warnings": list(self.vm_warnings),
+            "fingerprints": self.vm_fingerprints,
         }
 
+    def keep_vms(self, vmids):
+        """Mark the existing VMs with these VMIDs as matched without comparing
+        them, for syncs that only re-read some of the VMs.
+
+        Returns the IDs of the kept VMs."""
+        vmids = set(vmids)
+        mapped_ids = set(self.vm_mappings[vmid][0] for vmid in vmids if vmid in self.vm_mappings)
+        unmapped_vmids = [vmid for vmid in vmids if vmid not in self.vm_mappings]
+        matches = Q(pk__in=mapped_ids)
+        if unmapped_vmids:
+            matches |= Q(custom_field_data__vmid__in=unmapped_vmids)
+        kept = set(
+            pk for pk in VirtualMachine.objects.using(self.using).filter(
+                matches, cluster_id=self.connection.cluster.id
+            ).values_list('pk', flat=True)
+            if pk in mapped_ids or pk not in self.mapped_vm_ids
+        )
+        self.matched_existing_vms.update(kept)
+        return kept
+
+    def finish_vms(self):
+        """Existing VMs that were not matched by any chunk, to be deleted."""
+        return [
+            on_primary(vm) for vm in VirtualMachine.objects.using(self.using).filter(
+                pk__in=self.existing_vm_ids - self.matched_existing_vms
+            )
+        ]
+
     def _vms_equal(self, px_vm, nb_vm, devices_by_name={}, tags_by_name={}):
-        if px_vm["name"] != nb_vm.name:
+        if px_vm.name != nb_vm.name:
             return False
-        if devices_by_name.get(px_vm["device"]["name"]) is None:
-            if Device.objects.filter(name=px_vm["device"]["name"]).exists():
+        if devices_by_name.get(px_vm.device) is None:
+            if self.device_index.exists(px_vm.device):
                 self.vm_warnings.add(
-                    f"Device '{px_vm['device']['name']}' exists but is not assigned to Cluster "
+                    f"Device '{px_vm.device}' exists but is not assigned to Cluster "
                     f"'{self.connection.cluster.name}'."
                 )
             else:
                 self.vm_warnings.add(
-                    f"Device '{px_vm['device']['name']}' not found. Please create it and assign to Cluster "
+                    f"Device '{px_vm.device}' not found. Please create it and assign to Cluster "
                     f"'{self.connection.cluster.name}'."
                 )
         elif nb_vm.device is None:
             return False
-        elif px_vm["device"]["name"] != nb_vm.device.name:
+        elif px_vm.device != nb_vm.device.name:
             return False
-        if px_vm["status"] != nb_vm.status:
+        if px_vm.status != nb_vm.status:
             return False
-        if px_vm["vcpus"] != nb_vm.vcpus:
+        if px_vm.vcpus != nb_vm.vcpus:
             return False
-        if px_vm["memory"] != nb_vm.memory:
+        if px_vm.memory != nb_vm.memory:
             return False
-        if px_vm["disk"] != nb_vm.disk:
+        if px_vm.disk != nb_vm.disk:
             return False
-        if px_vm["custom_fields"]["vmid"] != nb_vm.custom_field_data["vmid"]:
+        if px_vm.vmid != nb_vm.custom_field_data["vmid"]:
             return False
-        nb_tags = set([tag.name for tag in nb_vm.tags.all()])
-        for px_tag in px_vm["tags"]:
-            if px_tag["name"] not in nb_tags and tags_by_name.get(px_tag["name"]) is not None:
+        nb_tags = self.vm_tag_names.get(nb_vm.pk)
+        if nb_tags is None:
+            nb_tags = set([tag.name for tag in nb_vm.tags.all()])
+        for px_tag in px_vm.tags:
+            if px_tag not in nb_tags and tags_by_name.get(px_tag) is not None:
                 return False
         return True
 
     def categorize_vminterfaces(self, parsed_vminterfaces):
-        existing_vms = VirtualMachine.objects.filter(cluster_id=self.connection.cluster.id)
-        existing_vminterfaces = VMInterface.objects.filter(virtual_machine__in=existing_vms).prefetch_related('mac_addresses')
+        self.begin_vminterfaces()
+        categorized = self.categorize_vminterfaces_chunk(parsed_vminterfaces)
+        categorized["delete"] = self.finish_vminterfaces()
+        return categorized
+
+    def begin_vminterfaces(self):
+        """Prepare categorizing the VM interfaces of this cluster, which can
+        then be passed to categorize_vminterfaces_chunk() in chunks. As for
+        VMs, only the mapping table and the IDs of the existing interfaces are
+        read here."""
+        self.existing_vminterface_ids = set(
+            VMInterface.objects.using(self.using).filter(
+                virtual_machine__cluster_id=self.connection.cluster.id
+            ).values_list('pk', flat=True)
+        )
+        # (vmid, net index) -> interface ID, the primary identity of an interface
+        self.vminterface_mappings = {
+            (vmid, net_index): vmi_id
+            for vmid, net_index, vmi_id in ProxmoxVMInterfaceMapping.objects.filter(
+                connection=self.connection
+            ).values_list('vmid', 'net_index', 'vminterface_id')
+        }
+
+        self.vminterface_fingerprints = self._fingerprint_store(ProxmoxObjectFingerprint.KIND_VMINTERFACE)
+
+        self.vminterface_names_to_create = set()
+        self.vminterface_names_to_update = set()
         
-        existing_vminterfaces_by_name = {
+        self.matched_vminterface_ids = set()
+
+    def _load_vminterfaces(self, parsed_vminterfaces):
+        """
+        Read the existing interfaces of this cluster's VMs a chunk of parsed
+        interfaces can match (through the mapping of their (VMID, netN), by
+        MAC or by name), with their cables and IPs in bulk, so comparing them
+        is pure in-memory work.
+        """
+        vmi_ct = ContentType.objects.get_for_model(VMInterface)
+        keys = set((px_vmi.vmid, px_vmi.net_index) for px_vmi in parsed_vminterfaces)
+        mapped_ids = set(self.vminterface_mappings[key] for key in keys if key in self.vminterface_mappings)
+        macs = set(px_vmi.mac_address for px_vmi in parsed_vminterfaces if px_vmi.mac_address)
+        matches = Q(pk__in=mapped_ids) | Q(name__in=set(px_vmi.name for px_vmi in parsed_vminterfaces))
+        if macs:
+            matches |= Q(pk__in=MACAddress.objects.using(self.using).filter(
+                assigned_object_type=vmi_ct, mac_address__in=macs
+            ).values('assigned_object_id'))
+        existing_vminterfaces = [
+            on_primary(vmi) for vmi in VMInterface.objects.using(self.using).filter(
+                matches, virtual_machine__cluster_id=self.connection.cluster.id
+            )
+            .select_related('virtual_machine', 'untagged_vlan')
+            .prefetch_related('mac_addresses')
+        ]
+        vmi_ids = [vmi.pk for vmi in existing_vminterfaces]
+
+        self.cabled_vminterface_ids = set(
+            CableTermination.objects.using(self.using).filter(
+                termination_type=vmi_ct,
+                termination_id__in=vmi_ids,
+            ).values_list('termination_id', flat=True)
+        )
+        self.ips_by_vminterface_id = {}
+        for vmi_id, address in IPAddress.objects.using(self.using).filter(
+            assigned_object_type=vmi_ct,
+            assigned_object_id__in=vmi_ids,
+        ).values_list('assigned_object_id', 'address'):
+            self.ips_by_vminterface_id.setdefault(vmi_id, set()).add(str(address))
+        
+        self.existing_vminterfaces_by_name = {
             vmi.name: vmi for vmi in existing_vminterfaces
         }
         
-        existing_vminterfaces_by_mac = {}
+        self.existing_vminterfaces_by_mac = {}
         for vmi in existing_vminterfaces:
             for mac in vmi.mac_addresses.all():
-                existing_vminterfaces_by_mac[str(mac.mac_address).upper()] = vmi
+                self.existing_vminterfaces_by_mac[str(mac.mac_address).upper()] = vmi
 
-        vlans_by_vid = {vlan.vid: vlan for vlan in VLAN.objects.all()}
+        existing_vminterfaces_by_pk = {vmi.pk: vmi for vmi in existing_vminterfaces}
+        self.existing_vminterfaces_by_key = {
+            key: existing_vminterfaces_by_pk[self.vminterface_mappings[key]]
+            for key in keys
+            if self.vminterface_mappings.get(key) in existing_vminterfaces_by_pk
+        }
 
+    def categorize_vminterfaces_chunk(self, parsed_vminterfaces):
         create = []
         update = []
-        delete = []
+        remap = []
 
-        names_to_create = set()
-        names_to_update = set()
-        
-        matched_ids = set()
+        # Resolve the VLANs of the whole chunk in one query
+        parsed_vminterfaces = list(parsed_vminterfaces)
+        self._load_vminterfaces(parsed_vminterfaces)
+        self.vlan_index.load(px_vmi.untagged_vid for px_vmi in parsed_vminterfaces)
 
         for px_vmi in parsed_vminterfaces:
             nb_vmi = None
+            px_key = (px_vmi.vmid, px_vmi.net_index)
             
-            # 1. Try to match by MAC Address
-            px_mac = str(px_vmi.get("mac_address", "")).upper()
-            if px_mac and px_mac in existing_vminterfaces_by_mac:
-                nb_vmi = existing_vminterfaces_by_mac[px_mac]
+            # 1. Try to match by (VMID, netN), which survives renames and MAC changes
+            if px_key in self.existing_vminterfaces_by_key:
+                nb_vmi = self.existing_vminterfaces_by_key[px_key]
+
+            # 2. Try to match by MAC Address
+            px_mac = str(px_vmi.mac_address).upper()
+            if not nb_vmi and px_mac and px_mac in self.existing_vminterfaces_by_mac:
+                nb_vmi = self.existing_vminterfaces_by_mac[px_mac]
 
-            # 2. Try to match by Name
-            if not nb_vmi and px_vmi["name"] in existing_vminterfaces_by_name:
-                nb_vmi = existing_vminterfaces_by_name[px_vmi["name"]]
+            # 3. Try to match by Name
+            if not nb_vmi and px_vmi.name in self.existing_vminterfaces_by_name:
+                nb_vmi = self.existing_vminterfaces_by_name[px_vmi.name]
 
             if not nb_vmi:
-                if px_vmi["name"] not in names_to_create:
+                if px_vmi.name not in self.vminterface_names_to_create:
                     # Not sure why yet, but randomly proxmox sends me duplicated stuff
                     # (maybe in between migrations it gets messed up?)
-                    names_to_create.add(px_vmi["name"])
+                    self.vminterface_names_to_create.add(px_vmi.name)
                     create.append(px_vmi)
                     continue
             
-            matched_ids.add(nb_vmi.pk)
-            
-            if not self._vminterfaces_equal(px_vmi, nb_vmi, vlans_by_vid):
-                if px_vmi["name"] not in names_to_update:
-                    names_to_update.add(px_vmi["name"])
-                    update.append({"before": nb_vmi, "after": px_vmi})
+            self.matched_vminterface_ids.add(nb_vmi.pk)
 
-        for vmi in existing_vminterfaces:
-            if vmi.pk not in matched_ids:
-                # Skip deletion for interfaces that look like VPN/Software interfaces
-                # e.g. wg*, tun*, lo*, or interfaces without MAC (often virtual)
-                if vmi.name.startswith(('wg', 'tun', 'lo', 'enc')):
-                    continue
-                
-                # Also skip if it has a description indicating it's managed by OPNsense/WireGuard
-                if vmi.description and ('WireGuard' in vmi.description or 'OPNsense' in vmi.description):
-                    continue
+            if None not in px_key and self.vminterface_mappings.get(px_key) != nb_vmi.pk:
+                remap.append(Change(nb_vmi, px_vmi))
 
-                delete.append(vmi)
+            digest = fingerprint(px_vmi) if self.vminterface_fingerprints else None
+            if digest and self.vminterface_fingerprints.is_unchanged(nb_vmi.pk, digest):
+                continue
+            
+            if not self._vminterfaces_equal(px_vmi, nb_vmi):
+                if px_vmi.name not in self.vminterface_names_to_update:
+                    self.vminterface_names_to_update.add(px_vmi.name)
+                    update.append(Change(nb_vmi, px_vmi))
+            elif digest:
+                self.vminterface_fingerprints.mark(nb_vmi.pk, digest)
 
         return {
             "create": create,
             "update": update,
-            "delete": delete,
+            "delete": [],
+            "remap": remap,
             "warnings": list(self.vminterface_warnings),
+            "fingerprints": self.vminterface_fingerprints,
         }
 
-    def _vminterfaces_equal(self, px_vmi, nb_vmi, vlans_by_vid={}):
+    def keep_vminterfaces(self, virtual_machine_ids):
+        """Mark the existing interfaces of these VMs as matched without comparing them."""
+        self.matched_vminterface_ids.update(
+            VMInterface.objects.using(self.using).filter(
+                virtual_machine_id__in=virtual_machine_ids
+            ).values_list('pk', flat=True)
+        )
+
+    def finish_vminterfaces(self):
+        """Existing VM interfaces that were not matched by any chunk, to be deleted."""
+        unmatched = VMInterface.objects.using(self.using).filter(
+            pk__in=self.existing_vminterface_ids - self.matched_vminterface_ids
+        ).select_related('virtual_machine')
+        delete = []
+        for vmi in unmatched:
+            # Skip deletion for interfaces that look like VPN/Software interfaces
+            # e.g. wg*, tun*, lo*, or interfaces without MAC (often virtual)
+            if vmi.name.startswith(('wg', 'tun', 'lo', 'enc')):
+                continue
+            
+            # Also skip if it has a description indicating it's managed by OPNsense/WireGuard
+            if vmi.description and ('WireGuard' in vmi.description or 'OPNsense' in vmi.description):
+                continue
+
+            delete.append(on_primary(vmi))
+        return delete
+
+    def _vminterfaces_equal(self, px_vmi, nb_vmi):
         # Check VLAN
-        px_vid = px_vmi.get("untagged_vlan", {}).get("vid") if px_vmi.get("untagged_vlan") else None
+        px_vid = px_vmi.untagged_vid
         
         if px_vid is not None:
-            if vlans_by_vid.get(px_vid) is None:
+            px_vlan = self.vlan_index.get(px_vid)
+            if int(px_vid) in self.vlan_index.ambiguous:
+                self.vminterface_warnings.add(
+                    f"VLAN with VID={px_vid} is ambiguous in the scope of cluster "
+                    f"'{self.connection.cluster}'!"
+                )
+            if px_vlan is None:
                 self.vminterface_warnings.add(
                     f"VLAN with VID={px_vid} was not found!"
                 )
@@ -259,34 +514,24 @@ class NetBoxCategorizer:
                 # we technically differ, but we can't fix it.
             elif nb_vmi.untagged_vlan is None:
                 return False
-            elif int(px_vid) != int(nb_vmi.untagged_vlan.vid):
+            elif px_vlan.pk != nb_vmi.untagged_vlan_id:
                 return False
         else:
             # Proxmox has no VLAN (untagged)
             if nb_vmi.untagged_vlan is not None:
                 return False
 
-        if px_vmi["name"] != nb_vmi.name:
+        if px_vmi.name != nb_vmi.name:
             return False
-        if px_vmi["virtual_machine"]["name"] != nb_vmi.virtual_machine.name:
+        if px_vmi.virtual_machine != nb_vmi.virtual_machine.name:
             return False
         
         # Check Cabling
-        if px_vmi.get("bridge"):
-            # Check if cable exists using CableTermination lookup (safest method)
-            from dcim.models import CableTermination
-            from django.contrib.contenttypes.models import ContentType
-            
-            vmi_ct = ContentType.objects.get_for_model(VMInterface)
-            has_cable = CableTermination.objects.filter(
-                termination_type=vmi_ct, 
-                termination_id=nb_vmi.pk
-            ).exists()
-
-            if not has_cable:
+        if px_vmi.bridge:
+            if nb_vmi.pk not in self.cabled_vminterface_ids:
                 return False
         
-        px_mac = str(px_vmi["mac_address"]).upper()
+        px_mac = str(px_vmi.mac_address).upper()
         nb_macs = [str(m.mac_address).upper() for m in nb_vmi.mac_addresses.all()]
         
         if not nb_macs:
@@ -296,9 +541,8 @@ class NetBoxCategorizer:
                  return False
         
         # Check IPs
-        px_ips = set(px_vmi.get("ip_addresses", []))
-        # Use the reverse relation from IPAddress to VMInterface
-        nb_ips = set([str(ip.address) for ip in nb_vmi.ip_addresses.all()])
+        px_ips = set(px_vmi.ip_addresses)
+        nb_ips = self.ips_by_vminterface_id.get(nb_vmi.pk, set())
         
         if px_ips != nb_ips:
             return False
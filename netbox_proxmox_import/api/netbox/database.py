@@ -0,0 +1,72 @@
+import logging
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ..config import get_plugin_setting
+
+logger = logging.getLogger(__name__)
+
+# Seconds the replica is behind the primary: 0 when it has replayed
+# everything it received, NULL when it has never replayed anything
+POSTGRESQL_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+def get_read_database():
+    """
+    The database alias the categorize phase reads NetBox objects from: the
+    configured replica_database, unless it lags more than replica_max_lag
+    seconds behind (or its lag cannot be told), in which case the primary.
+    """
+    alias = get_plugin_setting('replica_database')
+    if not alias or alias == DEFAULT_DB_ALIAS:
+        return DEFAULT_DB_ALIAS
+    if alias not in settings.DATABASES:
+        logger.warning(f"Replica database '{alias}' is not configured, reading from the primary")
+        return DEFAULT_DB_ALIAS
+
+    max_lag = float(get_plugin_setting('replica_max_lag', 5))
+    try:
+        lag = replica_lag(alias)
+    except Exception as e:
+        logger.warning(f"Failed to check the lag of replica database '{alias}', reading from the primary: {e}")
+        return DEFAULT_DB_ALIAS
+    if lag is None or lag > max_lag:
+        logger.info(f"Replica database '{alias}' lags {lag}s behind, reading from the primary")
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def replica_lag(alias):
+    """Replication lag of alias in seconds (None if unknown). Only PostgreSQL
+    reports it, other databases are assumed to be in sync."""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(POSTGRESQL_LAG_SQL)
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return float(row[0])
+
+
+def on_primary(instance):
+    """
+    Bind an instance read from a replica (and the related objects cached on
+    it) to the primary, so saving or deleting it, or assigning it to a
+    relation of another object, writes to the primary.
+    """
+    if instance is None or instance._state.db == DEFAULT_DB_ALIAS:
+        return instance
+    instance._state.db = DEFAULT_DB_ALIAS
+    for related in instance._state.fields_cache.values():
+        if related is not None:
+            related._state.db = DEFAULT_DB_ALIAS
+    return instance
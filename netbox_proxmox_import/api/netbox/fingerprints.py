@@ -0,0 +1,82 @@
+import datetime
+import hashlib
+import json
+
+from django.utils import timezone
+
+from ...models import ProxmoxObjectFingerprint
+
+
+def fingerprint(record):
+    """Stable hash of a parsed Proxmox record."""
+    if hasattr(record, "_asdict"):
+        record = record._asdict()
+    payload = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class FingerprintStore:
+    """
+    The fingerprints of one kind of object synced by a connection.
+
+    An object whose parsed Proxmox record still hashes to its stored
+    fingerprint is considered unchanged, until its last full comparison
+    ("reconcile") is older than reconcile_interval seconds.
+    """
+
+    def __init__(self, connection, kind, reconcile_interval):
+        self.connection = connection
+        self.kind = kind
+        self.reconcile_interval = datetime.timedelta(seconds=reconcile_interval)
+        self.now = timezone.now()
+        self.existing = {
+            object_id: (digest, reconciled)
+            for object_id, digest, reconciled in ProxmoxObjectFingerprint.objects.filter(
+                connection=connection, kind=kind
+            ).values_list('object_id', 'fingerprint', 'reconciled')
+        }
+        self.pending = {}
+        self.forgotten = set()
+
+    def is_unchanged(self, object_id, digest):
+        stored = self.existing.get(object_id)
+        if stored is None:
+            return False
+        return stored[0] == digest and self.now - stored[1] < self.reconcile_interval
+
+    def mark(self, object_id, digest):
+        """Remember that object_id was just reconciled against a record hashing to digest."""
+        self.pending[object_id] = digest
+
+    def forget(self, object_id):
+        self.pending.pop(object_id, None)
+        self.forgotten.add(object_id)
+
+    def save(self):
+        if self.forgotten:
+            ProxmoxObjectFingerprint.objects.filter(
+                connection=self.connection, kind=self.kind, object_id__in=self.forgotten
+            ).delete()
+            for object_id in self.forgotten:
+                self.existing.pop(object_id, None)
+            self.forgotten = set()
+        if self.pending:
+            now = timezone.now()
+            ProxmoxObjectFingerprint.objects.bulk_create(
+                [
+                    ProxmoxObjectFingerprint(
+                        connection=self.connection,
+                        kind=self.kind,
+                        object_id=object_id,
+                        fingerprint=digest,
+                        reconciled=now,
+                    )
+                    for object_id, digest in self.pending.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['connection', 'kind', 'object_id'],
+                update_fields=['fingerprint', 'reconciled'],
+            )
+            for object_id, digest in self.pending.items():
+                self.existing[object_id] = (digest, now)
+            self.pending = {}
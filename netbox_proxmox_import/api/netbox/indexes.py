@@ -0,0 +1,143 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS
+from dcim.models import Device, Location, Region, Site, SiteGroup
+from ipam.models import VLAN
+from virtualization.models import Cluster, ClusterGroup
+
+from .database import on_primary
+
+
+def cluster_site(cluster):
+    """The site of a cluster, whether it has a scope (NetBox >= 4.2) or a site."""
+    return getattr(cluster, "_site", None) or getattr(cluster, "site", None)
+
+
+class DeviceIndex:
+    """
+    Device names loaded once per sync: the devices of the synced cluster, and
+    the names of every device in NetBox. Resolves "device not found / not in
+    cluster" checks and node name fallbacks without a query per VM.
+
+    Devices may be read from a replica (using); they are bound to the primary
+    so the updater can assign them.
+    """
+
+    def __init__(self, cluster, using=DEFAULT_DB_ALIAS):
+        self.cluster = cluster
+        self.using = using
+        self.devices_by_name = {
+            device.name: on_primary(device)
+            for device in Device.objects.using(using).filter(cluster_id=cluster.id)
+        }
+        self.ids_by_name = {}
+        self.ids_by_lower_name = {}
+        for pk, name in Device.objects.using(using).exclude(name__isnull=True).values_list('pk', 'name'):
+            self.ids_by_name.setdefault(name, pk)
+            self.ids_by_lower_name.setdefault(name.lower(), pk)
+        self._resolved = {}
+
+    def add(self, device):
+        """Register a device created in the cluster during the sync."""
+        self.devices_by_name[device.name] = device
+        self.ids_by_name.setdefault(device.name, device.pk)
+        self.ids_by_lower_name.setdefault(device.name.lower(), device.pk)
+
+    def in_cluster(self, name):
+        return self.devices_by_name.get(name)
+
+    def exists(self, name):
+        return name in self.ids_by_name
+
+    def find(self, name):
+        """A device by exact, then case-insensitive name, in any cluster."""
+        if not name:
+            return None
+        device = self.devices_by_name.get(name)
+        if device is not None:
+            return device
+        pk = self.ids_by_name.get(name) or self.ids_by_lower_name.get(name.lower())
+        if pk is None:
+            return None
+        if pk not in self._resolved:
+            self._resolved[pk] = on_primary(Device.objects.using(self.using).filter(pk=pk).first())
+        return self._resolved[pk]
+
+
+class VLANIndex:
+    """
+    VLANs by VID as seen from a cluster, loaded lazily and only for the VIDs
+    that are asked for. A VID can exist many times across NetBox, so the most
+    specific VLAN wins: one assigned to the cluster's site, then one in a VLAN
+    group scoped to the cluster, its group, its location, site, site group or
+    region (in that order), then a global VLAN. Outside of that scope a VLAN
+    is only used when its VID is unique in NetBox.
+    """
+
+    def __init__(self, cluster, using=DEFAULT_DB_ALIAS):
+        self.cluster = cluster
+        self.using = using
+        self.site = cluster_site(cluster)
+        self.ambiguous = set()
+        self._vlans_by_vid = {}
+
+        scopes = [
+            (Cluster, cluster.pk),
+            (ClusterGroup, getattr(cluster, "group_id", None)),
+            (Location, getattr(cluster, "_location_id", None)),
+            (Site, self.site.pk if self.site else None),
+            (SiteGroup, getattr(self.site, "group_id", None)),
+            (Region, getattr(self.site, "region_id", None)),
+        ]
+        self._group_scopes = [
+            (ContentType.objects.get_for_model(model).pk, pk)
+            for model, pk in scopes if pk is not None
+        ]
+
+    def load(self, vids):
+        """Resolve the given VIDs at once, skipping the ones already resolved."""
+        vids = set(int(vid) for vid in vids if vid is not None) - set(self._vlans_by_vid)
+        if not vids:
+            return
+        candidates = {}
+        for vlan in VLAN.objects.using(self.using).filter(vid__in=vids).select_related('group'):
+            candidates.setdefault(vlan.vid, []).append(vlan)
+        for vid in vids:
+            self._vlans_by_vid[vid] = on_primary(self._pick(vid, candidates.get(vid, [])))
+
+    def get(self, vid):
+        if vid is None:
+            return None
+        vid = int(vid)
+        if vid not in self._vlans_by_vid:
+            self.load([vid])
+        return self._vlans_by_vid[vid]
+
+    def _rank(self, vlan):
+        if self.site is not None and vlan.site_id == self.site.pk:
+            return 0
+        if vlan.group is not None:
+            scope = (vlan.group.scope_type_id, vlan.group.scope_id)
+            if scope in self._group_scopes:
+                return 1 + self._group_scopes.index(scope)
+            if vlan.group.scope_type_id is None and vlan.site_id is None:
+                return 1 + len(self._group_scopes)
+            return None
+        if vlan.site_id is None:
+            return 1 + len(self._group_scopes)
+        return None
+
+    def _pick(self, vid, vlans):
+        ranked = sorted(
+            ((self._rank(vlan), vlan.pk, vlan) for vlan in vlans if self._rank(vlan) is not None),
+            key=lambda ranked_vlan: ranked_vlan[:2],
+        )
+        if ranked:
+            best = [vlan for rank, _, vlan in ranked if rank == ranked[0][0]]
+            if len(best) > 1:
+                self.ambiguous.add(vid)
+            return best[0]
+        if len(vlans) == 1:
+            return vlans[0]
+        if vlans:
+            self.ambiguous.add(vid)
+        return None
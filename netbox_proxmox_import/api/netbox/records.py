@@ -0,0 +1,55 @@
+import sys
+from typing import Any, NamedTuple, Optional, Tuple
+
+
+def intern(value):
+    """sys.intern() for the strings repeated across records (node, VM,
+    bridge and tag names, statuses), passing anything else through."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ParsedTag(NamedTuple):
+    name: str
+    slug: str
+    color: str
+
+
+class ParsedNode(NamedTuple):
+    name: str
+    status: str
+    # Raw network interfaces of the node, as returned by Proxmox
+    interfaces: Tuple[dict, ...] = ()
+    network_error: Optional[str] = None
+
+
+class ParsedVM(NamedTuple):
+    name: str
+    status: str
+    # Name of the node the VM runs on (the NetBox device)
+    device: Optional[str]
+    vcpus: int
+    memory: int
+    disk: int
+    tags: Tuple[str, ...]
+    vmid: Optional[int]
+
+
+class ParsedVMInterface(NamedTuple):
+    name: str
+    # Name of the VM the interface belongs to
+    virtual_machine: str
+    vmid: Optional[int]
+    net_index: Optional[int]
+    mac_address: Optional[str]
+    mode: str
+    ip_addresses: Tuple[str, ...]
+    bridge: Optional[str]
+    node: Optional[str]
+    untagged_vid: Optional[int]
+
+
+class Change(NamedTuple):
+    """An existing NetBox object and the parsed record it should match."""
+
+    before: Any
+    after: Any
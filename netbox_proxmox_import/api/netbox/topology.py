@@ -0,0 +1,198 @@
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from dcim.models import Cable, CableTermination, Interface
+from virtualization.models import VMInterface
+
+from . import bulk
+
+logger = logging.getLogger(__name__)
+
+
+class TopologyBuilder:
+    """
+    The node side of VM interfaces: every VM interface on a bridge gets a
+    tap<vmid>i<n> interface on the device of its node, bridged to the bridge
+    interface and cabled to the VM interface.
+
+    The wanted links are collected with add(), then apply() loads the
+    interfaces and cable terminations of all involved devices at once and
+    only writes what differs. Interfaces already loaded by the node update
+    (interfaces by (device ID, name), covering all interfaces of the devices
+    in loaded_devices) are reused instead of read again, and the interfaces
+    created here are added to them.
+    """
+
+    def __init__(self, device_index, interfaces=None, loaded_devices=()):
+        self.device_index = device_index
+        self.interfaces = interfaces if interfaces is not None else {}
+        self.loaded_devices = loaded_devices
+        # (device ID, tap name) -> (device, bridge name, VM interface)
+        self.links = {}
+
+    def add(self, vmi, node_name, bridge_name, vmid, net_index):
+        if not bridge_name:
+            return
+        # Try to get device from VM first (most reliable if user renamed device)
+        device = vmi.virtual_machine.device
+        # Fallback to node_name lookup
+        if not device and node_name:
+            device = self.device_index.find(node_name)
+        if not device:
+            logger.warning(f"Could not determine Device for VM {vmi.virtual_machine.name} (Node: {node_name}) - Cabling skipped.")
+            return
+        if vmid is None or net_index is None:
+            logger.warning(f"VM {vmi.virtual_machine.name} has no VMID, skipping tap creation.")
+            return
+        self.links[(device.pk, f"tap{vmid}i{net_index}")] = (device, bridge_name, vmi)
+
+    def apply(self):
+        """
+        Write the collected links. Returns how many cables were kept, created
+        and replaced, and the (VM interface, exception) of each cable that
+        could not be created.
+        """
+        counts = {"kept": 0, "created": 0, "replaced": 0}
+        failures = []
+        if not self.links:
+            return counts, failures
+
+        interfaces = self._ensure_interfaces()
+        cables = self._load_cables(interfaces)
+
+        vmi_ct = ContentType.objects.get_for_model(VMInterface)
+        iface_ct = ContentType.objects.get_for_model(Interface)
+        stale_cables = set()
+        to_cable = []
+        for (device_id, tap_name), (device, bridge_name, vmi) in self.links.items():
+            tap = interfaces[(device_id, tap_name)]
+            vmi_cable = cables.get((vmi_ct.pk, vmi.pk))
+            tap_cable = cables.get((iface_ct.pk, tap.pk))
+            if vmi_cable is not None and vmi_cable == tap_cable:
+                counts["kept"] += 1
+                continue
+            # Connected to something else (on either end), replace
+            stale = set(cable for cable in (vmi_cable, tap_cable) if cable is not None)
+            stale_cables.update(stale)
+            to_cable.append((vmi, tap, "replaced" if stale else "created"))
+
+        if stale_cables:
+            # A queryset delete still sends the (path tracing) signals of every cable
+            Cable.objects.filter(pk__in=stale_cables).delete()
+        # Cables are created one by one, the bookkeeping of their terminations
+        # (cached link peers, cable paths) only happens in save()
+        for vmi, tap, outcome in to_cable:
+            try:
+                self._create_cable(vmi_ct, vmi, iface_ct, tap)
+            except Exception as e:
+                logger.error(f"Failed to create cable between {vmi} and {tap}: {e}")
+                failures.append((vmi, e))
+            else:
+                counts[outcome] += 1
+
+        logger.info(
+            f"Topology: {counts['kept']} cables kept, {counts['created']} created, {counts['replaced']} replaced, "
+            f"{len(failures)} failed"
+        )
+        return counts, failures
+
+    def _ensure_interfaces(self):
+        """Create missing bridge and tap interfaces and fix the bridge of
+        existing taps (in bulk with bulk_writes, see bulk.write()). Returns
+        interfaces by (device ID, name)."""
+        devices = {device.pk: device for device, _, _ in self.links.values()}
+        names = set(tap_name for _, tap_name in self.links)
+        names.update(bridge_name for _, bridge_name, _ in self.links.values())
+        interfaces = self.interfaces
+        unloaded = [pk for pk in devices if pk not in self.loaded_devices]
+        if unloaded:
+            interfaces.update(
+                ((iface.device_id, iface.name), iface)
+                for iface in Interface.objects.filter(device_id__in=unloaded, name__in=names)
+            )
+
+        # If bridge doesn't exist, we create it
+        new_bridges = {}
+        for device, bridge_name, _ in self.links.values():
+            if (device.pk, bridge_name) not in interfaces:
+                new_bridges[(device.pk, bridge_name)] = Interface(
+                    device=device, name=bridge_name, type="bridge", **cached_location(device)
+                )
+        interfaces.update(zip(new_bridges.keys(), bulk.write(Interface, created=new_bridges.values())))
+
+        new_taps = {}
+        rebridged = []
+        for (device_id, tap_name), (device, bridge_name, vmi) in self.links.items():
+            bridge = interfaces[(device_id, bridge_name)]
+            tap = interfaces.get((device_id, tap_name))
+            if tap is None:
+                new_taps[(device_id, tap_name)] = Interface(
+                    device=device,
+                    name=tap_name,
+                    type="virtual",
+                    bridge=bridge,
+                    description=f"Uplink for {vmi.virtual_machine.name}",
+                    **cached_location(device)
+                )
+            elif tap.bridge_id != bridge.pk:
+                # Ensure it is bridged correctly
+                bulk.snapshot([tap])
+                tap.bridge = bridge
+                rebridged.append(tap)
+        interfaces.update(zip(new_taps.keys(), bulk.write(Interface, rebridged, ["bridge"], new_taps.values())))
+
+        if new_bridges or new_taps:
+            logger.info(f"Created {len(new_bridges)} bridge and {len(new_taps)} tap interfaces")
+            # save() keeps the counter up to date, bulk_create() does not
+            if bulk.bulk_enabled():
+                bulk.refresh_counter(devices.keys(), "interface_count", Interface, "device")
+        return interfaces
+
+    def _load_cables(self, interfaces):
+        """Cable IDs by (termination type ID, termination ID) of the VM and tap interfaces."""
+        vmi_ct = ContentType.objects.get_for_model(VMInterface)
+        iface_ct = ContentType.objects.get_for_model(Interface)
+        vmi_ids = [vmi.pk for _, _, vmi in self.links.values()]
+        tap_ids = [interfaces[key].pk for key in self.links]
+        terminations = CableTermination.objects.filter(
+            termination_type=vmi_ct, termination_id__in=vmi_ids
+        ) | CableTermination.objects.filter(
+            termination_type=iface_ct, termination_id__in=tap_ids
+        )
+        return {
+            (type_id, termination_id): cable_id
+            for type_id, termination_id, cable_id in terminations.values_list(
+                'termination_type_id', 'termination_id', 'cable_id'
+            )
+        }
+
+    def _create_cable(self, vmi_ct, vmi, iface_ct, tap):
+        # Atomic, so a failure does not leave a cable without terminations behind
+        with transaction.atomic():
+            cable = Cable.objects.create(status='connected')
+            CableTermination.objects.create(
+                cable=cable,
+                termination_type=vmi_ct,
+                termination_id=vmi.pk,
+                cable_end='A'
+            )
+            CableTermination.objects.create(
+                cable=cable,
+                termination_type=iface_ct,
+                termination_id=tap.pk,
+                cable_end='B'
+            )
+            cable.save()
+        logger.info(f"Created cable between {vmi} and {tap}")
+
+
+def cached_location(device):
+    """The cached _site/_location/_rack fields of a device component, which
+    save() fills in (NetBox >= 4.3) but bulk_create() does not."""
+    fields = set(field.name for field in Interface._meta.concrete_fields)
+    return {
+        f"_{name}_id": getattr(device, f"{name}_id", None)
+        for name in ("site", "location", "rack")
+        if f"_{name}" in fields
+    }
@@ -2,20 +2,55 @@ import json
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.serializers import serialize
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
 from extras.models import Tag
-from dcim.models import Device, MACAddress, Interface, Cable, DeviceRole, DeviceType, Manufacturer, Site
-from dcim.models import CableTermination
+from dcim.models import Device, MACAddress, Interface, DeviceRole, DeviceType, Manufacturer, Site
 from virtualization.models import VirtualMachine, VMInterface
-from ipam.models import VLAN, IPAddress
+from ipam.models import IPAddress, VRF
+
+from ..config import get_plugin_setting
+from ..proxmox.netconfig import normalize_mac
+from ...models import ProxmoxVMInterfaceMapping, ProxmoxVMMapping
+from .fingerprints import fingerprint
+from . import bulk
+from .indexes import DeviceIndex, VLANIndex, cluster_site
+from .topology import TopologyBuilder, cached_location
 
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Proxmox network interface type -> NetBox interface type (others are virtual)
+NODE_INTERFACE_TYPES = {
+    "eth": "1000base-t",
+    "bridge": "bridge",
+    "bond": "lag",
+}
+NODE_VIRTUAL_TYPES = ("virtual", "bridge", "lag")
+
 class NetBoxUpdater:
-    def __init__(self, proxmox_connection):
+    def __init__(self, proxmox_connection, device_index=None, vlan_index=None):
         self.connection = proxmox_connection
+        self._device_index = device_index
+        self._vlan_index = vlan_index
+        # Interfaces by (device ID, name) of the nodes written by update_nodes(),
+        # and the IDs of those devices, whose interfaces are all in it
+        self.node_interfaces = {}
+        self.loaded_devices = set()
+
+    @property
+    def device_index(self):
+        if self._device_index is None:
+            self._device_index = DeviceIndex(self.connection.cluster)
+        return self._device_index
+
+    @property
+    def vlan_index(self):
+        if self._vlan_index is None:
+            self._vlan_index = VLANIndex(self.connection.cluster)
+        return self._vlan_index
 
     def update_tags(self, categorized_tags, nodelete_tagnames=set()):
         errors = []
@@ -28,9 +63,9 @@ class NetBoxUpdater:
         for tag in categorized_tags["create"]:
             try:
                 new_tag = Tag.objects.create(
-                    name=tag["name"],
-                    slug=tag["slug"],
-                    color=tag["color"],
+                    name=tag.name,
+                    slug=tag.slug,
+                    color=tag.color,
                     # object_types=[vm_contenttype]
                 )
                 new_tag.object_types.set([vm_contenttype.id])
@@ -39,9 +74,9 @@ class NetBoxUpdater:
                 errors.append(e)
         # ======================================================================================== #
         for tag in categorized_tags["update"]:
-            updated_tag = tag["before"]
-            updated_tag.slug = tag["after"]["slug"]
-            updated_tag.color = tag["after"]["color"]
+            updated_tag = tag.before
+            updated_tag.slug = tag.after.slug
+            updated_tag.color = tag.after.color
             try:
                 # Note: if another cluster has a different color this will keep updating too
                 # Yeah... Idk man... Multi-cluster while managing tags too is weird
@@ -88,52 +123,139 @@ class NetBoxUpdater:
         if not site:
             site = Site.objects.create(name="Default Site", slug="default-site")
 
+        errors = []
+        created = []
+        updated = []
+        # (device, Proxmox network interfaces) of every node written
+        synced = []
+
         for node in categorized_nodes["create"]:
             try:
                 device = Device.objects.create(
-                    name=node["name"],
+                    name=node.name,
                     device_type=dtype,
                     role=role,
                     site=site,
                     cluster=self.connection.cluster,
-                    status=node["status"]
+                    status=node.status
                 )
-                self._sync_node_interfaces(device, node["interfaces"])
-            except Exception:
-                pass
+                # VMs on the new node are written after the nodes, they can be assigned to it
+                self.device_index.add(device)
+                synced.append((device, node.interfaces))
+                created.append(device)
+            except Exception as e:
+                errors.append(e)
         
         for node in categorized_nodes["update"]:
             try:
-                device = node["before"]
-                device.status = node["after"]["status"]
+                device = node.before
+                device.status = node.after.status
                 device.cluster = self.connection.cluster # Ensure cluster association
                 device.save()
-                self._sync_node_interfaces(device, node["after"]["interfaces"])
-            except Exception:
-                pass
+                synced.append((device, node.after.interfaces))
+                updated.append(device)
+            except Exception as e:
+                errors.append(e)
 
-    def _sync_node_interfaces(self, device, interfaces):
-        if not interfaces: return
-        
-        for iface in interfaces:
-            iface_name = iface.get('iface')
-            if not iface_name: continue
-            
-            if_type = "virtual"
-            if iface.get('type') == 'eth': if_type = "1000base-t"
-            elif iface.get('type') == 'bridge': if_type = "bridge"
-            elif iface.get('type') == 'bond': if_type = "lag"
-            
-            nb_iface = Interface.objects.filter(device=device, name=iface_name).first()
-            if not nb_iface:
-                nb_iface = Interface.objects.create(
+        # Each batch of nodes is written in its own transaction, so a failing
+        # batch (or a concurrent sync of a node shared with another cluster)
+        # only holds back its own nodes
+        batch_size = max(1, int(get_plugin_setting('node_batch_size', 10) or 1))
+        for batch in bulk.chunked(synced, batch_size):
+            try:
+                with transaction.atomic():
+                    self._sync_node_interfaces(batch)
+            except Exception as e:
+                errors.append(e)
+
+        return {
+            "created": json.loads(serialize("json", created)),
+            "updated": json.loads(serialize("json", updated)),
+            "deleted": [],
+            "errors": [str(e) for e in errors],
+            "warnings": categorized_nodes["warnings"]
+        }
+
+    def _sync_node_interfaces(self, nodes):
+        """
+        Create the missing network interfaces of a batch of (device, Proxmox
+        network interfaces) nodes and set the bridge of bridge ports and the
+        LAG of bond slaves. All interfaces of the devices are read with one
+        query and kept in self.node_interfaces, so the topology of the VM
+        interfaces does not need to look them up again. They are written in
+        bulk with bulk_writes, see bulk.write().
+        """
+        devices = {device.pk: device for device, interfaces in nodes if interfaces}
+        if not devices:
+            return
+        interfaces = self._load_node_interfaces(devices.keys())
+
+        new = {}
+        for device, px_interfaces in nodes:
+            for iface in px_interfaces:
+                iface_name = iface.get('iface')
+                if not iface_name or (device.pk, iface_name) in interfaces:
+                    continue
+                new.setdefault((device.pk, iface_name), Interface(
                     device=device,
                     name=iface_name,
-                    type=if_type
-                )
-            
-            # Update bridge/bond relationships if needed?
-            # For now just ensuring existence is enough for the topology linker
+                    type=NODE_INTERFACE_TYPES.get(iface.get('type'), "virtual"),
+                    **cached_location(device)
+                ))
+        if new and bulk.bulk_enabled():
+            # Another sync may have created some of them in the meantime; with
+            # ignore_conflicts no primary keys are returned, so read them back
+            Interface.objects.bulk_create(new.values(), ignore_conflicts=True)
+            interfaces = self._load_node_interfaces(devices.keys())
+            created = [interfaces[key] for key in new if key in interfaces]
+            logger.info(f"Created {len(created)} node interfaces")
+            bulk.refresh_counter(devices.keys(), "interface_count", Interface, "device")
+            bulk.set_no_tags(created)
+            changelog = bulk.ChangeLog()
+            changelog.created(created)
+            changelog.save()
+            transaction.on_commit(lambda: bulk.cache_search(created))
+        elif new:
+            # One save() each, a conflicting concurrent sync fails the batch
+            interfaces.update(zip(new.keys(), bulk.write(Interface, created=new.values())))
+            logger.info(f"Created {len(new)} node interfaces")
+
+        # Bridge ports and bond slaves, e.g. {"iface": "vmbr0", "type": "bridge", "bridge_ports": "bond0"}
+        changed = {}
+        for device, px_interfaces in nodes:
+            for iface in px_interfaces:
+                parent = interfaces.get((device.pk, iface.get('iface')))
+                if iface.get('type') == 'bridge':
+                    field_name, members = "bridge", iface.get('bridge_ports')
+                elif iface.get('type') == 'bond':
+                    field_name, members = "lag", iface.get('slaves')
+                else:
+                    continue
+                # Only LAG interfaces can have members
+                if parent is None or (field_name == "lag" and parent.type != "lag"):
+                    continue
+                for member_name in str(members or '').split():
+                    member = interfaces.get((device.pk, member_name))
+                    if member is None or member.pk == parent.pk:
+                        continue
+                    # Virtual interfaces cannot be LAG members
+                    if field_name == "lag" and member.type in NODE_VIRTUAL_TYPES:
+                        continue
+                    if getattr(member, f"{field_name}_id") != parent.pk:
+                        if member.pk not in changed:
+                            bulk.snapshot([member])
+                            changed[member.pk] = member
+                        setattr(member, field_name, parent)
+        bulk.write(Interface, changed.values(), ["bridge", "lag"])
+
+        self.node_interfaces.update(interfaces)
+        self.loaded_devices.update(devices)
+
+    def _load_node_interfaces(self, device_ids):
+        return {
+            (iface.device_id, iface.name): iface
+            for iface in Interface.objects.filter(device_id__in=device_ids)
+        }
 
     def update_vms(self, categorized_vms):
         errors = []
@@ -141,47 +263,64 @@ class NetBoxUpdater:
         updated = []
         deleted = []
 
+        fingerprints = categorized_vms.get("fingerprints")
+        # VMID -> (node, VirtualMachine) to store in the mapping table
+        mappings = {
+            vm.after.vmid: (vm.after.device, vm.before)
+            for vm in categorized_vms.get("remap", [])
+        }
+
         tags_by_name = {
             t.name: t for t in Tag.objects.filter(slug__istartswith=f"nbpsync__")
         }
-        devices_by_name = {
-            device.name: device for device in Device.objects.filter(cluster=self.connection.cluster)
-        }
+        devices_by_name = self.device_index.devices_by_name
+
+        if bulk.bulk_enabled():
+            self._bulk_write_vms(
+                categorized_vms, tags_by_name, devices_by_name, created, updated, mappings, errors
+            )
+            categorized_vms = dict(categorized_vms, create=[], update=[])
 
         for vm in categorized_vms["create"]:
             try:
                 new_vm = VirtualMachine.objects.create(
-                    name=vm["name"],
-                    status=vm["status"],
-                    device=devices_by_name.get(vm["device"]["name"]),
+                    name=vm.name,
+                    status=vm.status,
+                    device=devices_by_name.get(vm.device),
                     cluster=self.connection.cluster,
-                    vcpus=vm["vcpus"],
-                    memory=vm["memory"],
-                    disk=vm["disk"],
-                    # tags=[tags_by_name.get(tag["name"]) for tag in vm["tags"]],
-                    custom_field_data=vm["custom_fields"],
+                    vcpus=vm.vcpus,
+                    memory=vm.memory,
+                    disk=vm.disk,
+                    # tags=[tags_by_name.get(tag) for tag in vm.tags],
+                    custom_field_data={"vmid": vm.vmid},
                 )
-                tags = [ tags_by_name.get(tag["name"]) for tag in vm["tags"] ]
+                tags = [ tags_by_name.get(tag) for tag in vm.tags ]
                 new_vm.save()
                 new_vm.tags.set([ tag for tag in tags if tag is not None ])
                 created.append(new_vm)
+                mappings[vm.vmid] = (vm.device, new_vm)
+                if fingerprints:
+                    fingerprints.mark(new_vm.pk, fingerprint(vm))
             except Exception as e:
                 errors.append(e)
         # ======================================================================================== #
         for vm in categorized_vms["update"]:
-            updated_vm = vm["before"]
-            updated_vm.name = vm["after"]["name"]  # Update name if changed
-            updated_vm.status = vm["after"]["status"]
-            updated_vm.vcpus = vm["after"]["vcpus"]
-            updated_vm.memory = vm["after"]["memory"]
-            updated_vm.disk = vm["after"]["disk"]
-            updated_vm.custom_field_data["vmid"] = vm["after"]["custom_fields"]["vmid"]
-            updated_vm.device = devices_by_name.get(vm["after"]["device"]["name"])
+            updated_vm = vm.before
+            updated_vm.name = vm.after.name  # Update name if changed
+            updated_vm.status = vm.after.status
+            updated_vm.vcpus = vm.after.vcpus
+            updated_vm.memory = vm.after.memory
+            updated_vm.disk = vm.after.disk
+            updated_vm.custom_field_data["vmid"] = vm.after.vmid
+            updated_vm.device = devices_by_name.get(vm.after.device)
             try:
-                tags = [ tags_by_name.get(tag["name"]) for tag in vm["after"]["tags"] ]
+                tags = [ tags_by_name.get(tag) for tag in vm.after.tags ]
                 updated_vm.save()
                 updated_vm.tags.set([ tag for tag in tags if tag is not None ])
                 updated.append(updated_vm)
+                mappings[vm.after.vmid] = (vm.after.device, updated_vm)
+                if fingerprints:
+                    fingerprints.mark(updated_vm.pk, fingerprint(vm.after))
             except Exception as e:
                 errors.append(e)
         # ======================================================================================== #
@@ -195,9 +334,18 @@ class NetBoxUpdater:
                 
                 # Append dict instead of object
                 deleted.append({"pk": vm_id, "model": "virtualization.virtualmachine", "fields": {"name": vm_str}})
+                if fingerprints:
+                    fingerprints.forget(vm_id)
             except Exception as e:
                 errors.append(e)
 
+        try:
+            self._save_vm_mappings(mappings)
+        except Exception as e:
+            errors.append(e)
+        if fingerprints:
+            fingerprints.save()
+
         return {
             "created": json.loads(serialize("json", created)),
             "updated": json.loads(serialize("json", updated)),
@@ -205,263 +353,428 @@ class NetBoxUpdater:
             "errors": [str(e) for e in errors],
             "warnings": categorized_vms["warnings"]
         }
+
+    def _bulk_write_vms(self, categorized_vms, tags_by_name, devices_by_name, created, updated, mappings, errors):
+        """
+        Create and update VMs with bulk_create()/bulk_update(), chunk_size
+        VMs (and one transaction) at a time. Signals do not fire for these
+        writes, so tags, search indexing and (optionally) change logging are
+        done here in bulk too. A failing chunk is rolled back as a whole.
+        """
+        fingerprints = categorized_vms.get("fingerprints")
+        chunk_size = bulk.bulk_chunk_size()
+        site = cluster_site(self.connection.cluster)
+        changelog = bulk.ChangeLog()
+
+        for chunk in bulk.chunked(categorized_vms["create"], chunk_size):
+            try:
+                with transaction.atomic():
+                    new_vms = VirtualMachine.objects.bulk_create([
+                        VirtualMachine(
+                            name=vm.name,
+                            status=vm.status,
+                            device=devices_by_name.get(vm.device),
+                            cluster=self.connection.cluster,
+                            site=site,
+                            vcpus=vm.vcpus,
+                            memory=vm.memory,
+                            disk=vm.disk,
+                            custom_field_data={"vmid": vm.vmid},
+                        )
+                        for vm in chunk
+                    ])
+                    bulk.set_tags({
+                        new_vm: [tags_by_name.get(tag) for tag in vm.tags]
+                        for vm, new_vm in zip(chunk, new_vms)
+                    })
+                    changelog.created(new_vms)
+                    changelog.save()
+            except Exception as e:
+                changelog.discard()
+                errors.append(e)
+                continue
+            bulk.cache_search(new_vms)
+            created.extend(new_vms)
+            for vm, new_vm in zip(chunk, new_vms):
+                mappings[vm.vmid] = (vm.device, new_vm)
+                if fingerprints:
+                    fingerprints.mark(new_vm.pk, fingerprint(vm))
+
+        for chunk in bulk.chunked(categorized_vms["update"], chunk_size):
+            updated_vms = [vm.before for vm in chunk]
+            try:
+                with transaction.atomic():
+                    changelog.snapshot(updated_vms)
+                    for vm in chunk:
+                        updated_vm = vm.before
+                        updated_vm.name = vm.after.name  # Update name if changed
+                        updated_vm.status = vm.after.status
+                        updated_vm.vcpus = vm.after.vcpus
+                        updated_vm.memory = vm.after.memory
+                        updated_vm.disk = vm.after.disk
+                        updated_vm.custom_field_data["vmid"] = vm.after.vmid
+                        updated_vm.device = devices_by_name.get(vm.after.device)
+                    VirtualMachine.objects.bulk_update(
+                        updated_vms,
+                        ["name", "status", "vcpus", "memory", "disk", "custom_field_data", "device"]
+                        + bulk.touch(updated_vms, "_name", "last_updated"),
+                    )
+                    bulk.set_tags({
+                        vm.before: [tags_by_name.get(tag) for tag in vm.after.tags] for vm in chunk
+                    })
+                    changelog.updated(updated_vms)
+                    changelog.save()
+            except Exception as e:
+                changelog.discard()
+                errors.append(e)
+                continue
+            bulk.cache_search(updated_vms)
+            updated.extend(updated_vms)
+            for vm in chunk:
+                mappings[vm.after.vmid] = (vm.after.device, vm.before)
+                if fingerprints:
+                    fingerprints.mark(vm.before.pk, fingerprint(vm.after))
+
+    def _save_vm_mappings(self, mappings):
+        mappings = {
+            vmid: (node, vm) for vmid, (node, vm) in mappings.items()
+            if vmid is not None and vm.pk is not None
+        }
+        if not mappings:
+            return
+        # Replace whatever these VMIDs or VMs were mapped to before
+        ProxmoxVMMapping.objects.filter(
+            Q(connection=self.connection, vmid__in=mappings.keys())
+            | Q(virtual_machine_id__in=[vm.pk for _, vm in mappings.values()])
+        ).delete()
+        ProxmoxVMMapping.objects.bulk_create([
+            ProxmoxVMMapping(connection=self.connection, vmid=vmid, node=node or "", virtual_machine=vm)
+            for vmid, (node, vm) in mappings.items()
+        ])
+
     def update_vminterfaces(self, categorized_vminterfaces):
         errors = []
         created = []
         updated = []
         deleted = []
 
-        vms_by_name = {
-            vm.name: vm for vm in VirtualMachine.objects.filter(cluster=self.connection.cluster)
+        fingerprints = categorized_vminterfaces.get("fingerprints")
+        # (VMID, net index) -> VMInterface to store in the mapping table
+        mappings = {
+            (vmi.after.vmid, vmi.after.net_index): vmi.before
+            for vmi in categorized_vminterfaces.get("remap", [])
         }
-        vlans_by_vid = { vlan.vid: vlan for vlan in VLAN.objects.all() }
+
+        # Only the VMs of these interfaces, a streamed chunk does not read the whole cluster
+        vm_names = set(vmi.virtual_machine for vmi in categorized_vminterfaces["create"])
+        vm_names.update(vmi.after.virtual_machine for vmi in categorized_vminterfaces["update"])
+        vms_by_name = {
+            vm.name: vm for vm in VirtualMachine.objects.filter(
+                cluster=self.connection.cluster, name__in=vm_names
+            ).select_related('device')
+        } if vm_names else {}
         vminterface_ct = ContentType.objects.get_for_model(VMInterface)
+        # VM interface -> MAC and addresses, assigned all at once after the interfaces are written
+        mac_targets = {}
+        ip_targets = {}
+        # Node side interfaces and cables, also written at once
+        topology = TopologyBuilder(self.device_index, self.node_interfaces, self.loaded_devices)
 
         for vmi in categorized_vminterfaces["create"]:
             try:
                 new_vmi = VMInterface.objects.create(
-                    name=vmi["name"],
-                    virtual_machine=vms_by_name.get(vmi["virtual_machine"]["name"]),
-                    mode=vmi["mode"],
-                    untagged_vlan=vlans_by_vid.get(vmi["untagged_vlan"]["vid"]) if vmi["untagged_vlan"] else None,
+                    name=vmi.name,
+                    virtual_machine=vms_by_name.get(vmi.virtual_machine),
+                    mode=vmi.mode,
+                    untagged_vlan=self.vlan_index.get(vmi.untagged_vid),
                 )
-                
-                if vmi["mac_address"]:
-                    MACAddress.objects.update_or_create(
-                        mac_address=vmi["mac_address"],
-                        defaults={
-                            'assigned_object_type': vminterface_ct,
-                            'assigned_object_id': new_vmi.pk
-                        }
-                    )
-                
-                self._update_ips(new_vmi, vmi.get("ip_addresses", []))
-                self._update_cable(new_vmi, vmi.get("name"), vmi.get("node"), vmi.get("bridge"))
+
+                mac_targets[new_vmi] = vmi.mac_address
+                ip_targets[new_vmi] = vmi.ip_addresses
+                topology.add(new_vmi, vmi.node, vmi.bridge, vmi.vmid, vmi.net_index)
                 
                 created.append(new_vmi)
+                mappings[(vmi.vmid, vmi.net_index)] = new_vmi
+                if fingerprints:
+                    fingerprints.mark(new_vmi.pk, fingerprint(vmi))
             except Exception as e:
                 errors.append(e)
         # ======================================================================================== #
         for vmi in categorized_vminterfaces["update"]:
-            updated_vmi = vmi["before"]
-            updated_vmi.mode = vmi["after"]["mode"]
-            updated_vmi.untagged_vlan = vlans_by_vid.get(vmi["after"]["untagged_vlan"]["vid"]) if vmi["after"]["untagged_vlan"] else None
-            updated_vmi.virtual_machine = vms_by_name.get(vmi["after"]["virtual_machine"]["name"])
+            updated_vmi = vmi.before
+            updated_vmi.name = vmi.after.name  # Update name if the VM was renamed
+            updated_vmi.mode = vmi.after.mode
+            updated_vmi.untagged_vlan = self.vlan_index.get(vmi.after.untagged_vid)
+            updated_vmi.virtual_machine = vms_by_name.get(vmi.after.virtual_machine)
             try:
                 updated_vmi.save()
-                
-                if vmi["after"]["mac_address"]:
-                    mac_obj, _ = MACAddress.objects.update_or_create(
-                        mac_address=vmi["after"]["mac_address"],
-                        defaults={
-                            'assigned_object_type': vminterface_ct,
-                            'assigned_object_id': updated_vmi.pk
-                        }
-                    )
-                    # Delete other MACs assigned to this interface
-                    MACAddress.objects.filter(
-                        assigned_object_type=vminterface_ct,
-                        assigned_object_id=updated_vmi.pk
-                    ).exclude(pk=mac_obj.pk).delete()
-                else:
-                    MACAddress.objects.filter(
-                        assigned_object_type=vminterface_ct,
-                        assigned_object_id=updated_vmi.pk
-                    ).delete()
 
-                self._update_ips(updated_vmi, vmi["after"].get("ip_addresses", []))
-                self._update_cable(updated_vmi, vmi["after"].get("name"), vmi["after"].get("node"), vmi["after"].get("bridge"))
+                mac_targets[updated_vmi] = vmi.after.mac_address
+                ip_targets[updated_vmi] = vmi.after.ip_addresses
+                topology.add(updated_vmi, vmi.after.node, vmi.after.bridge, vmi.after.vmid, vmi.after.net_index)
 
                 updated.append(updated_vmi)
+                mappings[(vmi.after.vmid, vmi.after.net_index)] = updated_vmi
+                if fingerprints:
+                    fingerprints.mark(updated_vmi.pk, fingerprint(vmi.after))
             except Exception as e:
                 errors.append(e)
         # ======================================================================================== #
+        # The MACs of all deleted interfaces go at once
+        try:
+            deleted_ids = [vmi.pk for vmi in categorized_vminterfaces["delete"] if vmi.pk is not None]
+            if deleted_ids:
+                MACAddress.objects.filter(
+                    assigned_object_type=vminterface_ct,
+                    assigned_object_id__in=deleted_ids
+                ).delete()
+        except Exception as e:
+            errors.append(e)
         for vmi in categorized_vminterfaces["delete"]:
             try:
                 # Store ID and string representation before deletion for serialization
                 vmi_id = vmi.pk
                 vmi_str = str(vmi)
                 
-                MACAddress.objects.filter(
-                    assigned_object_type=vminterface_ct,
-                    assigned_object_id=vmi.pk
-                ).delete()
                 vmi.delete()
                 
                 # Create a dummy object or dict for the response since the real object is gone
                 # and Django serializer can't handle deleted objects with M2M relations
                 deleted.append({"pk": vmi_id, "model": "virtualization.vminterface", "fields": {"name": vmi_str}})
+                if fingerprints:
+                    fingerprints.forget(vmi_id)
             except ObjectDoesNotExist:
                 # in case it was cascade-deleted by a VM deletion
                 deleted.append({"pk": vmi.pk if vmi.pk else 0, "model": "virtualization.vminterface", "fields": {"name": str(vmi)}})
+                if fingerprints and vmi.pk:
+                    fingerprints.forget(vmi.pk)
             except Exception as e:
                 errors.append(e)
 
+        try:
+            self._reconcile_macs(mac_targets)
+        except Exception as e:
+            errors.append(e)
+            if fingerprints:
+                for vmi in mac_targets:
+                    fingerprints.forget(vmi.pk)
+        try:
+            self._reconcile_ips(ip_targets)
+        except Exception as e:
+            errors.append(e)
+            # Compare these interfaces in full again next time
+            if fingerprints:
+                for vmi in ip_targets:
+                    fingerprints.forget(vmi.pk)
+        try:
+            topology_counts, cable_failures = topology.apply()
+            for vmi, e in cable_failures:
+                errors.append(e)
+                # Retry the cable next time
+                if fingerprints:
+                    fingerprints.forget(vmi.pk)
+        except Exception as e:
+            errors.append(e)
+            topology_counts = {"kept": 0, "created": 0, "replaced": 0}
+            if fingerprints:
+                for link in topology.links.values():
+                    fingerprints.forget(link[2].pk)
+        try:
+            self._save_vminterface_mappings(mappings)
+        except Exception as e:
+            errors.append(e)
+        if fingerprints:
+            fingerprints.save()
+
         return {
             "created": json.loads(serialize("json", created)),
             "updated": json.loads(serialize("json", updated)),
             "deleted": deleted, # Now returning a list of dicts, not a serialized string
             "errors": [str(e) for e in errors],
             "warnings": categorized_vminterfaces["warnings"],
+            "cables": topology_counts,
         }
 
-    def _update_ips(self, vmi_obj, ip_list):
-        vminterface_ct = ContentType.objects.get_for_model(VMInterface)
-        
-        if not ip_list:
-            # If no IPs provided, unassign all currently assigned IPs
-            IPAddress.objects.filter(
-                assigned_object_type=vminterface_ct,
-                assigned_object_id=vmi_obj.pk
-            ).update(assigned_object_id=None, assigned_object_type=None)
+    def _save_vminterface_mappings(self, mappings):
+        mappings = {
+            key: vmi for key, vmi in mappings.items()
+            if None not in key and vmi.pk is not None
+        }
+        if not mappings:
             return
+        # Replace whatever these keys or interfaces were mapped to before; the
+        # rows of the VMIDs are narrowed down to the exact keys here, as one
+        # OR'ed condition per key gets too big for a first sync
+        vminterface_ids = set(vmi.pk for vmi in mappings.values())
+        stale = [
+            pk for pk, vmid, net_index, vminterface_id in ProxmoxVMInterfaceMapping.objects.filter(
+                Q(vminterface_id__in=vminterface_ids)
+                | Q(connection=self.connection, vmid__in=set(vmid for vmid, _ in mappings))
+            ).values_list('pk', 'vmid', 'net_index', 'vminterface_id')
+            if vminterface_id in vminterface_ids or (vmid, net_index) in mappings
+        ]
+        if stale:
+            ProxmoxVMInterfaceMapping.objects.filter(pk__in=stale).delete()
+        ProxmoxVMInterfaceMapping.objects.bulk_create(
+            [
+                ProxmoxVMInterfaceMapping(connection=self.connection, vmid=vmid, net_index=net_index, vminterface=vmi)
+                for (vmid, net_index), vmi in mappings.items()
+            ],
+            ignore_conflicts=True,
+        )
 
-        current_ips = {str(ip.address): ip for ip in IPAddress.objects.filter(
-            assigned_object_type=vminterface_ct,
-            assigned_object_id=vmi_obj.pk
-        )}
-        target_ips = set(ip_list)
-        
-        # Assign/Create new IPs
-        for ip_str in target_ips:
-            if ip_str not in current_ips:
-                try:
-                    # Check if IP exists anywhere
-                    ip_obj = IPAddress.objects.filter(address=ip_str).first()
-                    if not ip_obj:
-                        ip_obj = IPAddress.objects.create(
-                            address=ip_str,
-                            status='active'
-                        )
-                    
-                    # Assign to this interface
-                    ip_obj.assigned_object_type = vminterface_ct
-                    ip_obj.assigned_object_id = vmi_obj.pk
-                    ip_obj.save()
-                except Exception as e:
-                    # Log error?
-                    pass
-
-        # Unassign removed IPs
-        for ip_str, ip_obj in current_ips.items():
-            if ip_str not in target_ips:
-                ip_obj.assigned_object_type = None
-                ip_obj.assigned_object_id = None
-                ip_obj.save()
-
-    def _update_cable(self, vmi, px_iface_name, node_name, bridge_name):
-        if not bridge_name:
+    def _reconcile_macs(self, mac_targets):
+        """
+        Make the MAC addresses assigned to each VM interface in mac_targets
+        (interface -> MAC or None) exactly the given one. The MACs assigned to
+        these interfaces and the MACs with the wanted addresses are read with
+        one query and keyed by normalized address. An existing MAC is
+        reassigned (even from another interface, as Proxmox is authoritative),
+        a missing one created, and other MACs of the interfaces deleted (with
+        one bulk statement each with bulk_writes, see bulk.write()).
+        """
+        mac_targets = {
+            vmi: normalize_mac(str(mac)) if mac else None
+            for vmi, mac in mac_targets.items() if vmi.pk is not None
+        }
+        if not mac_targets:
             return
+        vminterface_ct = ContentType.objects.get_for_model(VMInterface)
+        vmi_ids = [vmi.pk for vmi in mac_targets]
+        wanted = set(mac for mac in mac_targets.values() if mac)
 
-        # Try to get device from VM first (most reliable if user renamed device)
-        device = vmi.virtual_machine.device
-        
-        # Fallback to node_name lookup
-        if not device and node_name:
-            device = Device.objects.filter(name=node_name).first()
-            if not device:
-                device = Device.objects.filter(name__iexact=node_name).first()
-        
-        if not device:
-            logger.warning(f"Could not determine Device for VM {vmi.virtual_machine.name} (Node: {node_name}) - Cabling skipped.")
-            return
+        relevant = Q(assigned_object_type=vminterface_ct, assigned_object_id__in=vmi_ids)
+        if wanted:
+            relevant |= Q(mac_address__in=wanted)
+        macs = list(MACAddress.objects.filter(relevant).prefetch_related('tags').order_by('pk'))
+        by_address = {}
+        for mac in macs:
+            by_address.setdefault(normalize_mac(str(mac.mac_address)), []).append(mac)
 
-        # Ensure Bridge Interface exists
-        bridge_iface = Interface.objects.filter(device=device, name=bridge_name).first()
-        if not bridge_iface:
-            # If bridge doesn't exist, we create it.
-            # But we should check if it's a valid bridge name to avoid creating garbage
-            bridge_iface = Interface.objects.create(device=device, name=bridge_name, type="bridge")
-            logger.info(f"Created missing bridge interface {bridge_name} on {device.name}")
-
-        # Determine Tap Interface Name
-        # px_iface_name format: "VMName:net0"
-        # We use the Proxmox name because the NetBox interface might have been renamed (e.g. to vtnet0)
-        iface_part = px_iface_name.split(':')[-1] # net0
-        if not iface_part.startswith('net'):
-            logger.debug(f"Proxmox Interface {px_iface_name} does not start with 'net', skipping tap creation.")
-            return
-        try:
-            net_idx = int(iface_part.replace('net', ''))
-        except ValueError:
-            logger.warning(f"Could not parse index from interface {px_iface_name}")
-            return
-            
-        # Get VMID
-        vmid = vmi.virtual_machine.custom_field_data.get('vmid')
-        if not vmid:
-            logger.warning(f"VM {vmi.virtual_machine.name} has no VMID, skipping tap creation.")
+        def assigned_to(mac, vmi):
+            return mac.assigned_object_type_id == vminterface_ct.pk and mac.assigned_object_id == vmi.pk
+
+        # pk -> MAC, for MACs that stay or move to the interface that wants them
+        claimed = {}
+        # pk -> (MAC, interface it moves to)
+        moves = {}
+        to_move = []
+        to_create = []
+        for vmi, address in mac_targets.items():
+            if not address:
+                continue
+            candidates = [mac for mac in by_address.get(address, []) if mac.pk not in claimed]
+            mac = next((mac for mac in candidates if assigned_to(mac, vmi)), None)
+            if mac is not None:
+                claimed[mac.pk] = mac
+                continue
+            # Claimed in a second pass, so a MAC already on its interface is not moved away
+            to_move.append((vmi, address))
+        for vmi, address in to_move:
+            mac = next((mac for mac in by_address.get(address, []) if mac.pk not in claimed), None)
+            if mac is None:
+                to_create.append(MACAddress(
+                    mac_address=address,
+                    assigned_object_type=vminterface_ct,
+                    assigned_object_id=vmi.pk,
+                ))
+            else:
+                claimed[mac.pk] = mac
+                moves[mac.pk] = (mac, vmi)
+        moved = [mac for mac, _ in moves.values()]
+        stale = [
+            mac.pk for mac in macs
+            if mac.pk not in claimed and any(assigned_to(mac, vmi) for vmi in mac_targets)
+        ]
+
+        with transaction.atomic():
+            if stale:
+                # A queryset delete still sends the (change logging) signals of every MAC
+                MACAddress.objects.filter(pk__in=stale).delete()
+            bulk.snapshot(moved)
+            for mac, vmi in moves.values():
+                mac.assigned_object_type = vminterface_ct
+                mac.assigned_object_id = vmi.pk
+            bulk.write(MACAddress, moved, ["assigned_object_type", "assigned_object_id"], to_create)
+
+    def _reconcile_ips(self, ip_targets):
+        """
+        Make the IPs assigned to each VM interface in ip_targets (interface ->
+        addresses) exactly the given ones, for all of them at once: one query
+        for their current IPs, one address__in query for the wanted ones (in
+        the VRF set by ip_vrf, or the global table), then the diff is written
+        (in bulk with bulk_writes, see bulk.write()).
+        """
+        ip_targets = {vmi: set(addresses) for vmi, addresses in ip_targets.items() if vmi.pk is not None}
+        if not ip_targets:
             return
-            
-        tap_name = f"tap{vmid}i{net_idx}"
-        
-        # Find/Create Tap Interface on Node
-        tap_iface = Interface.objects.filter(device=device, name=tap_name).first()
-        if not tap_iface:
-            tap_iface = Interface.objects.create(
-                device=device, 
-                name=tap_name, 
-                type="virtual", 
-                bridge=bridge_iface,
-                description=f"Uplink for {vmi.virtual_machine.name}"
-            )
-            logger.info(f"Created tap interface {tap_name} on {device.name}")
-        else:
-            # Ensure it is bridged correctly
-            if tap_iface.bridge != bridge_iface:
-                tap_iface.bridge = bridge_iface
-                tap_iface.save()
-                logger.info(f"Updated bridge for {tap_name} to {bridge_name}")
-
-        # Check if cable already exists
-        vmi_ct = ContentType.objects.get_for_model(VMInterface)
-        iface_ct = ContentType.objects.get_for_model(Interface)
-        
-        existing_term = CableTermination.objects.filter(
-            termination_type=vmi_ct, 
-            termination_id=vmi.pk
-        ).first()
-        
-        if existing_term:
-            # Check if connected to the correct tap interface
-            cable = existing_term.cable
-            if cable:
-                # Find the other end
-                other_end = cable.terminations.exclude(pk=existing_term.pk).first()
-                if other_end and other_end.termination == tap_iface:
-                    return # Already connected correctly
-                
-                # Connected to something else, delete
-                logger.info(f"Removing incorrect cable for {vmi.name}")
-                cable.delete()
-
-        # Also check if tap interface is connected to something else
-        tap_term = CableTermination.objects.filter(
-            termination_type=iface_ct,
-            termination_id=tap_iface.pk
-        ).first()
-        if tap_term and tap_term.cable:
-            logger.info(f"Removing incorrect cable for {tap_name}")
-            tap_term.cable.delete()
+        vrf = self._ip_vrf()
+        vminterface_ct = ContentType.objects.get_for_model(VMInterface)
+        vmis_by_pk = {vmi.pk: vmi for vmi in ip_targets}
 
-        try:
-            cable = Cable.objects.create(status='connected')
-            CableTermination.objects.create(
-                cable=cable, 
-                termination_type=vmi_ct, 
-                termination_id=vmi.pk, 
-                cable_end='A'
-            )
-            CableTermination.objects.create(
-                cable=cable, 
-                termination_type=iface_ct, 
-                termination_id=tap_iface.pk, 
-                cable_end='B'
-            )
-            cable.save()
-            logger.info(f"Created cable between {vmi} and {tap_iface}")
-        except Exception as e:
-            logger.error(f"Failed to create cable: {e}")
+        assigned = list(
+            IPAddress.objects.filter(assigned_object_type=vminterface_ct, assigned_object_id__in=vmis_by_pk.keys())
+            .prefetch_related('tags')
+        )
+        current = {vmi.pk: {} for vmi in ip_targets}
+        for ip in assigned:
+            current[ip.assigned_object_id][str(ip.address)] = ip
+
+        missing = set()
+        for vmi, addresses in ip_targets.items():
+            missing.update(addresses - set(current[vmi.pk]))
+        candidates = {}
+        if missing:
+            for ip in IPAddress.objects.filter(address__in=missing, vrf=vrf).prefetch_related('tags').order_by('pk'):
+                candidates.setdefault(str(ip.address), []).append(ip)
+
+        # pk -> (IP, interface it ends up assigned to, or None)
+        changes = {}
+        kept = set()
+        to_create = []
+        for vmi, addresses in ip_targets.items():
+            for address, ip in current[vmi.pk].items():
+                if address in addresses:
+                    kept.add(ip.pk)
+                else:
+                    changes[ip.pk] = (ip, None)
+        for vmi, addresses in ip_targets.items():
+            for address in sorted(addresses - set(current[vmi.pk])):
+                # Reuse an existing IP not kept or claimed by another interface
+                ip = next(
+                    (
+                        ip for ip in candidates.get(address, [])
+                        if ip.pk not in kept and changes.get(ip.pk, (ip, None))[1] is None
+                    ),
+                    None,
+                )
+                if ip is None:
+                    to_create.append(IPAddress(
+                        address=address,
+                        status='active',
+                        vrf=vrf,
+                        assigned_object_type=vminterface_ct,
+                        assigned_object_id=vmi.pk,
+                    ))
+                else:
+                    changes[ip.pk] = (ip, vmi)
+
+        with transaction.atomic():
+            updated_ips = [ip for ip, _ in changes.values()]
+            bulk.snapshot(updated_ips)
+            for ip, vmi in changes.values():
+                ip.assigned_object_type = vminterface_ct if vmi is not None else None
+                ip.assigned_object_id = vmi.pk if vmi is not None else None
+            bulk.write(IPAddress, updated_ips, ["assigned_object_type", "assigned_object_id"], to_create)
+
+    def _ip_vrf(self):
+        name = get_plugin_setting('ip_vrf')
+        if not name:
+            return None
+        vrf = VRF.objects.filter(name=name).first()
+        if vrf is None:
+            raise ValueError(f"VRF '{name}' (ip_vrf) was not found, IP addresses were not synced")
+        return vrf
 
     def create_mac_address(self, mac_address):
         return new_mac
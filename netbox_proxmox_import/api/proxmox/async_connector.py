@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from ..config import get_plugin_setting
+from .cache import AgentCache
+from .connector import Proxmox, is_debug
+
+logger = logging.getLogger(__name__)
+
+
+class ProxmoxAPIError(Exception):
+    pass
+
+
+class AsyncProxmox(Proxmox):
+    """
+    Proxmox connector backed by asyncio and a keep-alive aiohttp session.
+
+    It exposes the same (synchronous) methods as Proxmox, so the sync code does
+    not need to know which backend it talks to. Every public method drives a
+    private event loop, on which all per-VM and per-node requests are issued
+    concurrently instead of through a thread per request.
+    """
+
+
+    def __init__(self, config):
+        if aiohttp is None:
+            raise ImportError("The 'asyncio' connector backend requires aiohttp (pip install aiohttp)")
+
+        self.host = config["host"]
+        self.base_url = f"https://{config['host']}:{config['port']}/api2/json"
+        self.headers = {
+            "Authorization": f"PVEAPIToken={config['user']}!{config['token']['name']}={config['token']['value']}",
+        }
+        self.verify_ssl = config["verify_ssl"]
+        self.timeout = 30
+        # Upper bound of simultaneously open connections to the cluster
+        self.max_connections = max(1, int(config.get("async_max_connections", get_plugin_setting('async_max_connections', 100))))
+
+        self.vminterfaces = []
+        # The private event loop can only be driven by one thread at a time
+        self.lock = threading.RLock()
+        self._configure_concurrency(config)
+        self._configure_agent_cache(config)
+        self._configure_node_circuit(config)
+
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        # Agent refreshes scheduled on the loop, awaited before _run() returns
+        self._refresh_tasks = set()
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        for task in self._refresh_tasks:
+            task.cancel()
+        if self._refresh_tasks:
+            self._loop.run_until_complete(asyncio.gather(*self._refresh_tasks, return_exceptions=True))
+        if self._session is not None and not self._session.closed:
+            self._loop.run_until_complete(self._session.close())
+        self._loop.close()
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(self._with_refreshes(coro))
+
+    async def _with_refreshes(self, coro):
+        # Refreshes only progress while the loop runs: they overlap with the
+        # rest of the call, and are finished before the loop is given up so
+        # none is left waiting (on stale connections) until the next sync
+        try:
+            return await coro
+        finally:
+            if self._refresh_tasks:
+                await asyncio.gather(*list(self._refresh_tasks), return_exceptions=True)
+
+    def _get_session(self):
+        # The session has to be created from within the loop it is bound to
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                ssl=None if self.verify_ssl else False,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _get(self, path, **params):
+        session = self._get_session()
+        async with session.get(f"{self.base_url}/{path}", params=params or None) as response:
+            if response.status >= 400:
+                raise ProxmoxAPIError(f"{response.status} {response.reason}: {await response.text()}")
+            payload = await response.json()
+        return payload.get("data")
+
+    def get_tags(self):
+        try:
+            options = self._run(self._get("cluster/options"))
+            return self._tags_from_options(options)
+        except Exception as e:
+            logger.warning(f"Failed to retrieve tags from Proxmox: {e}")
+            return {}
+
+    def get_cluster(self):
+        try:
+            return self._run(self._get("cluster/status"))[0]
+        except Exception as e:
+            logger.exception("Failed to retrieve cluster status from Proxmox")
+            raise e
+
+    def get_nodes(self, names=None):
+        try:
+            return self._run(self._get_nodes(names))
+        except Exception as e:
+            logger.exception("Failed to retrieve Nodes from Proxmox")
+            return []
+
+    async def _get_nodes(self, names=None):
+        nodes = await self._get("nodes")
+        if names is not None:
+            nodes = [node for node in nodes if node['node'] in names]
+
+        async def fetch_network(node):
+            if not self.node_circuit.allow(node['node']):
+                return self._node_data(node, [], "skipped, node failed recently")
+            try:
+                network_interfaces = await asyncio.wait_for(
+                    self._get(f"nodes/{node['node']}/network"), timeout=self.node_timeout
+                )
+            except asyncio.TimeoutError:
+                self.node_circuit.record_failure(node['node'])
+                return self._node_data(node, [], f"timed out after {self.node_timeout}s")
+            except Exception as e:
+                self.node_circuit.record_failure(node['node'])
+                return self._node_data(node, [], str(e))
+            self.node_circuit.record_success(node['node'])
+            return self._node_data(node, network_interfaces)
+
+        # Fetch network interfaces for all nodes at once
+        return await asyncio.gather(*(fetch_network(node) for node in nodes))
+
+    def get_tasks(self):
+        return self._run(self._get("cluster/tasks"))
+
+    def _get_vm_resources(self):
+        return self._run(self._get("cluster/resources", type="vm"))
+
+    def _fetch_vms(self, vm_resources):
+        return self._run(self._fetch_vms_async(vm_resources))
+
+    async def _fetch_vms_async(self, vm_resources):
+        node_limits = {
+            node: asyncio.Semaphore(self._node_max_workers(node))
+            for node in set(vm.get('node') for vm in vm_resources)
+        }
+
+        async def fetch(vm):
+            async with node_limits[vm.get('node')]:
+                return await self._fetch_vm_async(vm)
+
+        # gather() keeps the order of vm_resources
+        return await asyncio.gather(*(fetch(vm) for vm in vm_resources))
+
+    async def _fetch_vm_async(self, vm):
+        path = f"nodes/{vm['node']}/qemu/{vm['vmid']}"
+        try:
+            if self.trust_resources:
+                vm_config = await self._get(f"{path}/config")
+                if self._needs_status_check(vm, vm_config):
+                    current_state = await self._get(f"{path}/status/current")
+                else:
+                    current_state = self._resource_state(vm)
+            else:
+                vm_config, current_state = await asyncio.gather(
+                    self._get(f"{path}/config"),
+                    self._get(f"{path}/status/current"),
+                )
+        except Exception as e:
+            logger.warning(f"Failed to retrieve config/status for VM {vm.get('vmid')} on node {vm.get('node')}: {e}")
+            return None
+
+        name = vm_config.get("name", vm.get("name", vm.get("vmid")))
+
+        agent_interfaces = []
+        try:
+            if self._should_query_agent(vm_config, current_state):
+                agent_interfaces = await self._cached_agent_interfaces_async(vm, path)
+                if is_debug():
+                    logger.info(f"VM {name} - Agent Interfaces: {len(agent_interfaces)} found")
+        except Exception as e:
+            # Agent might not be running or installed, or QEMU agent not enabled
+            if is_debug():
+                logger.info(f"VM {name} - Agent check failed: {e}")
+
+        return vm_config, current_state, agent_interfaces
+
+    async def _fetch_agent_interfaces_async(self, path):
+        agent_info = await self._get(f"{path}/agent/network-get-interfaces")
+        if agent_info and 'result' in agent_info:
+            return agent_info['result']
+        return []
+
+    async def _cached_agent_interfaces_async(self, vm, path):
+        if self.agent_cache is None:
+            return await self._fetch_agent_interfaces_async(path)
+        vmid = vm['vmid']
+        cached = self.agent_cache.get(vmid)
+        if cached is AgentCache.MISSING:
+            return await self._fetch_and_cache_agent(vmid, path)
+        if self.agent_cache.needs_refresh(vmid) and self.agent_cache.claim_refresh(vmid):
+            task = self._loop.create_task(self._refresh_agent(vmid, path))
+            self._refresh_tasks.add(task)
+            task.add_done_callback(self._refresh_tasks.discard)
+        return cached
+
+    async def _fetch_and_cache_agent(self, vmid, path):
+        try:
+            interfaces = await self._fetch_agent_interfaces_async(path)
+        except Exception:
+            self.agent_cache.set_failed(vmid)
+            raise
+        self.agent_cache.set(vmid, interfaces)
+        return interfaces
+
+    async def _refresh_agent(self, vmid, path):
+        try:
+            await self._fetch_and_cache_agent(vmid, path)
+        except Exception as e:
+            logger.debug(f"Background agent refresh of VM {vmid} failed: {e}")
+        finally:
+            self.agent_cache.release_refresh(vmid)
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..config import get_plugin_setting
+
+logger = logging.getLogger(__name__)
+
+# One cache per Proxmox connection, shared by every connector built for it in this process
+_agent_caches = {}
+_agent_caches_lock = threading.Lock()
+
+# Background refreshes of agent data that is about to expire
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="nbpsync-agent-refresh")
+
+
+def get_agent_cache(namespace):
+    """Return the agent cache of a connection, or None if caching is disabled."""
+    ttl = int(get_plugin_setting('agent_cache_ttl', 0) or 0)
+    if ttl <= 0:
+        return None
+    negative_ttl = get_plugin_setting('agent_cache_negative_ttl', None)
+    with _agent_caches_lock:
+        cache = _agent_caches.get(namespace)
+        if cache is None:
+            cache = AgentCache(
+                namespace,
+                ttl=ttl,
+                negative_ttl=None if negative_ttl is None else int(negative_ttl),
+                refresh_after=float(get_plugin_setting('agent_cache_refresh_after', 0.5)),
+                backend=get_plugin_setting('agent_cache_backend', None),
+            )
+            _agent_caches[namespace] = cache
+        return cache
+
+
+class AgentCache:
+    """
+    TTL cache of QEMU guest agent 'network-get-interfaces' results, keyed by VMID.
+
+    Failed lookups (agent missing, not running, timing out) are cached as
+    negative entries for negative_ttl, so a wedged agent is not waited on every
+    sync. Entries older than refresh_after * ttl are still served, but refreshed
+    in the background. If a Django cache alias is configured as backend (e.g.
+    the Redis backed 'default'), entries are shared with the other workers.
+    """
+
+    MISSING = object()
+
+    def __init__(self, namespace, ttl, negative_ttl=None, refresh_after=0.5, backend=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.refresh_after = refresh_after
+        self.backend = backend
+
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _key(self, vmid):
+        return f"netbox_proxmox_import:agent:{self.namespace}:{vmid}"
+
+    def _shared_cache(self):
+        if not self.backend:
+            return None
+        try:
+            from django.core.cache import caches
+            return caches[self.backend]
+        except Exception as e:
+            logger.warning(f"Agent cache backend '{self.backend}' is unavailable: {e}")
+            return None
+
+    def _load(self, vmid):
+        with self._lock:
+            entry = self._entries.get(vmid)
+        if entry is None:
+            shared = self._shared_cache()
+            if shared is not None:
+                entry = shared.get(self._key(vmid))
+                if entry is not None:
+                    with self._lock:
+                        self._entries[vmid] = entry
+        return entry
+
+    def _store(self, vmid, result):
+        entry = (time.time(), result)
+        with self._lock:
+            self._entries[vmid] = entry
+        shared = self._shared_cache()
+        if shared is not None:
+            timeout = self.ttl if result is not None else self.negative_ttl
+            shared.set(self._key(vmid), entry, timeout=timeout)
+
+    def get(self, vmid):
+        """
+        Return the cached interfaces of a VM, [] for a cached failure, or
+        AgentCache.MISSING if the VM has to be queried.
+        """
+        entry = self._load(vmid)
+        if entry is None:
+            return self.MISSING
+        stored_at, result = entry
+        age = time.time() - stored_at
+        if result is None:
+            return [] if age < self.negative_ttl else self.MISSING
+        return result if age < self.ttl else self.MISSING
+
+    def needs_refresh(self, vmid):
+        entry = self._load(vmid)
+        if entry is None or entry[1] is None:
+            return False
+        return time.time() - entry[0] >= self.ttl * self.refresh_after
+
+    def set(self, vmid, interfaces):
+        self._store(vmid, list(interfaces))
+
+    def set_failed(self, vmid):
+        if self.negative_ttl > 0:
+            self._store(vmid, None)
+
+    def fetch(self, vmid, fetch):
+        """Run fetch() and remember its result (or its failure)."""
+        try:
+            interfaces = fetch()
+        except Exception:
+            self.set_failed(vmid)
+            raise
+        self.set(vmid, interfaces)
+        return interfaces
+
+    def claim_refresh(self, vmid):
+        """Mark a VM as being refreshed, False if a refresh is already running."""
+        with self._lock:
+            if vmid in self._refreshing:
+                return False
+            self._refreshing.add(vmid)
+            return True
+
+    def release_refresh(self, vmid):
+        with self._lock:
+            self._refreshing.discard(vmid)
+
+    def refresh_in_background(self, vmid, fetch):
+        if not self.claim_refresh(vmid):
+            return
+
+        def refresh():
+            try:
+                self.fetch(vmid, fetch)
+            except Exception as e:
+                logger.debug(f"Background agent refresh of VM {vmid} failed: {e}")
+            finally:
+                self.release_refresh(vmid)
+
+        _refresh_executor.submit(refresh)
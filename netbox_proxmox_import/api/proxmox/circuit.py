@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class CircuitBreaker:
+    """
+    Per-key circuit breaker. After `threshold` consecutive failures a key is
+    considered dead and skipped for `reset_after` seconds, after which a single
+    attempt is let through again.
+    """
+
+    def __init__(self, threshold=2, reset_after=300):
+        self.threshold = max(1, int(threshold))
+        self.reset_after = reset_after
+        self._failures = {}
+        self._opened_at = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        with self._lock:
+            opened_at = self._opened_at.get(key)
+            if opened_at is None:
+                return True
+            if time.time() - opened_at >= self.reset_after:
+                # Half-open: let one attempt through, a failure reopens the circuit
+                self._opened_at[key] = time.time()
+                return True
+            return False
+
+    def is_open(self, key):
+        with self._lock:
+            return key in self._opened_at
+
+    def record_success(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened_at.pop(key, None)
+
+    def record_failure(self, key):
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures >= self.threshold:
+                self._opened_at[key] = time.time()
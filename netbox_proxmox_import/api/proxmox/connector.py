@@ -1,8 +1,16 @@
 from proxmoxer import ProxmoxAPI
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
-import re
+import threading
 from django.conf import settings
 
+from ..config import get_plugin_setting
+from .cache import AgentCache, get_agent_cache
+from .circuit import CircuitBreaker
+from .netconfig import NET_KEY_RE, index_agent_ips, parse_net_config
+from .snapshot import ClusterSnapshot, VMSnapshot
+from .tasks import changes_since
+
 logger = logging.getLogger(__name__)
 
 def is_debug():
@@ -30,40 +38,88 @@ class Proxmox:
             logger.exception(f"Failed to initialize Proxmox connection to {config.get('host')}")
             raise e
         self.vminterfaces = []
+        # Connectors are reused across syncs, so one sync at a time
+        self.lock = threading.RLock()
+        self._configure_concurrency(config)
+        self._configure_agent_cache(config)
+        self._configure_node_circuit(config)
+        self._configure_session_pool()
+
+    def _configure_concurrency(self, config):
+        # Concurrency of the per-VM fetches. max_workers bounds the whole pool,
+        # max_workers_per_node (optionally overridden per node name through
+        # node_max_workers) bounds the requests hitting a single node.
+        self.max_workers = max(1, int(config.get("max_workers", get_plugin_setting('max_workers', 8))))
+        self.max_workers_per_node = config.get("max_workers_per_node", get_plugin_setting('max_workers_per_node', 4))
+        self.node_max_workers = config.get("node_max_workers", get_plugin_setting('node_max_workers', {})) or {}
+        # Take VM status from cluster/resources and only ask status/current
+        # where it matters (confirming "running" before a guest agent query)
+        self.trust_resources = config.get("trust_resources", get_plugin_setting('trust_resources', False))
+
+    def _configure_agent_cache(self, config):
+        namespace = config.get("cache_key") or f"{config['host']}:{config['port']}"
+        self.agent_cache = get_agent_cache(namespace)
+
+    def _configure_node_circuit(self, config):
+        # Nodes whose network could not be read are skipped for a while
+        # instead of making every sync wait for them
+        self.node_timeout = config.get("node_timeout", get_plugin_setting('node_timeout', 10))
+        self.node_circuit = CircuitBreaker(
+            threshold=config.get("node_failure_threshold", get_plugin_setting('node_failure_threshold', 2)),
+            reset_after=config.get("node_circuit_reset", get_plugin_setting('node_circuit_reset', 300)),
+        )
+
+    def _configure_session_pool(self):
+        # Keep enough keep-alive connections around for every worker of the pool
+        session = getattr(self.proxmox, "_store", {}).get("session")
+        if session is None:
+            return
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def close(self):
+        session = getattr(self.proxmox, "_store", {}).get("session")
+        if session is not None:
+            session.close()
 
     def get_tags(self):
         try:
             options = self.proxmox.cluster.options.get()
-            tags = {}
-            
-            # Handle allowed-tags if present
-            allowed_tags = options.get("allowed-tags")
-            if allowed_tags:
-                # Ensure it's iterable
-                if isinstance(allowed_tags, str):
-                     # If it's a comma separated string
-                     allowed_tags = allowed_tags.split(',')
-                
-                for tag in allowed_tags:
-                    tags[tag.strip()] = None
-            
-            # Handle tag-style if present
-            tag_style = options.get("tag-style")
-            if tag_style and isinstance(tag_style, dict):
-                color_map = tag_style.get("color-map")
-                if color_map:
-                    for tag in color_map.split(';'):
-                        if ':' in tag:
-                            parts = tag.split(':')
-                            name = parts[0]
-                            color = parts[1]
-                            tags[name] = color
-            
-            return tags
+            return self._tags_from_options(options)
         except Exception as e:
             logger.warning(f"Failed to retrieve tags from Proxmox: {e}")
             return {}
 
+    def _tags_from_options(self, options):
+        tags = {}
+        
+        # Handle allowed-tags if present
+        allowed_tags = options.get("allowed-tags")
+        if allowed_tags:
+            # Ensure it's iterable
+            if isinstance(allowed_tags, str):
+                 # If it's a comma separated string
+                 allowed_tags = allowed_tags.split(',')
+            
+            for tag in allowed_tags:
+                tags[tag.strip()] = None
+        
+        # Handle tag-style if present
+        tag_style = options.get("tag-style")
+        if tag_style and isinstance(tag_style, dict):
+            color_map = tag_style.get("color-map")
+            if color_map:
+                for tag in color_map.split(';'):
+                    if ':' in tag:
+                        parts = tag.split(':')
+                        name = parts[0]
+                        color = parts[1]
+                        tags[name] = color
+        
+        return tags
+
     def get_cluster(self):
         try:
             return self.proxmox.cluster.status.get()[0]
@@ -71,124 +127,296 @@ class Proxmox:
             logger.exception("Failed to retrieve cluster status from Proxmox")
             raise e
 
-    def get_nodes(self):
+    def get_nodes(self, names=None):
         try:
             nodes = self.proxmox.nodes.get()
-            node_list = []
-            for node in nodes:
-                # Fetch network interfaces for the node
-                try:
-                    network_interfaces = self.proxmox.nodes(node['node']).network.get()
-                except Exception:
-                    network_interfaces = []
-                
-                node_data = {
-                    "name": node['node'],
-                    "status": node.get('status', 'unknown'),
-                    "cpu": node.get('cpu', 0),
-                    "maxcpu": node.get('maxcpu', 0),
-                    "mem": node.get('mem', 0),
-                    "maxmem": node.get('maxmem', 0),
-                    "interfaces": network_interfaces
-                }
-                node_list.append(node_data)
-            return node_list
         except Exception as e:
             logger.exception("Failed to retrieve Nodes from Proxmox")
             return []
+        if names is not None:
+            nodes = [node for node in nodes if node['node'] in names]
+        if not nodes:
+            return []
 
-    def get_vms(self):
+        # Fetch the network interfaces of all nodes in parallel, one worker
+        # (and request) per node so none waits in a queue, against a single
+        # deadline: every request gets node_timeout seconds from the start
+        allowed = [node for node in nodes if self.node_circuit.allow(node['node'])]
+        executor = ThreadPoolExecutor(max_workers=max(1, len(allowed)))
         try:
-            vm_resources = self.proxmox.cluster.resources.get(type="vm")
-            vms = []
-            for vm in vm_resources:
+            futures = {
+                node['node']: executor.submit(self._get_node_network, node['node'])
+                for node in allowed
+            }
+            _, pending = wait(futures.values(), timeout=self.node_timeout)
+
+            node_list = []
+            for node in nodes:
+                future = futures.get(node['node'])
+                if future is None:
+                    node_list.append(self._node_data(node, [], "skipped, node failed recently"))
+                    continue
+                if future in pending:
+                    future.cancel()
+                    self.node_circuit.record_failure(node['node'])
+                    node_list.append(self._node_data(node, [], f"timed out after {self.node_timeout}s"))
+                    continue
                 try:
-                    vm_config = self.proxmox.nodes(vm['node']).qemu(vm['vmid']).config.get()
-                    # Fetch authoritative status
-                    current_state = self.proxmox.nodes(vm['node']).qemu(vm['vmid']).status.current.get()
+                    network_interfaces = future.result()
                 except Exception as e:
-                    logger.warning(f"Failed to retrieve config/status for VM {vm.get('vmid')} on node {vm.get('node')}: {e}")
+                    self.node_circuit.record_failure(node['node'])
+                    node_list.append(self._node_data(node, [], str(e)))
                     continue
+                self.node_circuit.record_success(node['node'])
+                node_list.append(self._node_data(node, network_interfaces))
+            return node_list
+        finally:
+            # Do not wait for requests that already timed out
+            executor.shutdown(wait=False)
 
-                # Ensure name exists
-                if "name" not in vm_config:
-                    vm_config["name"] = vm.get("name", str(vm.get("vmid")))
+    def _get_node_network(self, node_name):
+        return self.proxmox.nodes(node_name).network.get()
 
-                # Try to get agent network info
-                agent_interfaces = []
-                try:
-                    # Only try if VM is running
-                    if current_state.get("status") == "running":
-                        agent_info = self.proxmox.nodes(vm['node']).qemu(vm['vmid']).agent('network-get-interfaces').get()
-                        if agent_info and 'result' in agent_info:
-                            agent_interfaces = agent_info['result']
-                            if is_debug():
-                                logger.info(f"VM {vm_config.get('name')} - Agent Interfaces: {len(agent_interfaces)} found")
-                except Exception as e:
-                    # Agent might not be running or installed, or QEMU agent not enabled
-                    if is_debug():
-                        logger.info(f"VM {vm_config.get('name')} - Agent check failed: {e}")
-                    pass
-
-                self._add_vminterfaces(vm_config, agent_interfaces)
-                
-                # Use status from current_state if available, else fallback to resource list
-                status = current_state.get("status", vm.get("status", "unknown"))
-                
-                vm_config["tags"] = [] if vm.get("tags") is None else str(vm.get("tags", "")).split(';')
-                vm_config["maxdisk"] = int(vm.get("maxdisk", 0))
-                vm_config["maxcpu"] = int(vm.get("maxcpu", 0))
-                vm_config["vmid"] = vm.get("vmid")
-                vm_config["node"] = vm.get("node")
-                vm_config["status"] = status
-                
-                if is_debug():
-                    logger.info(f"VM {vm_config.get('name')} ({vm.get('vmid')}) - Raw Status: {status}")
-                
-                vms.append(vm_config)
-            return vms
+    def _node_data(self, node, network_interfaces, network_error=None):
+        if network_error:
+            logger.warning(f"Failed to retrieve network interfaces of node {node['node']}: {network_error}")
+        return {
+            "name": node['node'],
+            "status": node.get('status', 'unknown'),
+            "cpu": node.get('cpu', 0),
+            "maxcpu": node.get('maxcpu', 0),
+            "mem": node.get('mem', 0),
+            "maxmem": node.get('maxmem', 0),
+            "interfaces": network_interfaces,
+            "network_error": network_error,
+        }
+
+    def get_snapshot(self):
+        """Read the cluster, its tags, nodes and VMs (with their interfaces) in one pass."""
+        return ClusterSnapshot(
+            cluster=self.get_cluster(),
+            tags=self.get_tags(),
+            nodes=self.get_nodes(),
+            vms=self.get_vm_snapshots(),
+        )
+
+    def get_partial_snapshot(self, vmids, node_names, known_vmids=()):
+        """Like get_snapshot(), but only reading the nodes in node_names and
+        the VMs in vmids, plus any VM whose VMID is not in known_vmids."""
+        try:
+            vm_resources = self._get_vm_resources()
+        except Exception as e:
+            logger.exception("Failed to retrieve VMs from Proxmox")
+            raise e
+        present_vmids = set(vm['vmid'] for vm in vm_resources)
+        vm_resources = [
+            vm for vm in vm_resources
+            if vm['vmid'] in vmids or vm['vmid'] not in known_vmids
+        ]
+        return ClusterSnapshot(
+            cluster=self.get_cluster(),
+            tags=self.get_tags(),
+            nodes=self.get_nodes(node_names),
+            vms=self._build_vms(vm_resources, self._fetch_vms(vm_resources)),
+            present_vmids=present_vmids,
+        )
+
+    def get_tasks(self):
+        return self.proxmox.cluster.tasks.get()
+
+    def get_task_changes(self, since):
+        """The VMs and nodes touched by a task since the since watermark."""
+        return changes_since(self.get_tasks(), since)
+
+    def get_vm_snapshots(self):
+        try:
+            vm_resources = self._get_vm_resources()
+            return self._build_vms(vm_resources, self._fetch_vms(vm_resources))
+        except Exception as e:
+            logger.exception("Failed to retrieve VMs from Proxmox")
+            raise e
+
+    def get_vms(self):
+        snapshots = self.get_vm_snapshots()
+        self.vminterfaces = [interface for vm in snapshots for interface in vm.interfaces]
+        return [vm.config for vm in snapshots]
+
+    def iter_vm_chunks(self, chunk_size):
+        """
+        Yield lists of VMSnapshot for chunk_size VMs at a time, so only one
+        chunk of VM configs and agent data is held in memory at once.
+        """
+        try:
+            vm_resources = self._get_vm_resources()
         except Exception as e:
             logger.exception("Failed to retrieve VMs from Proxmox")
             raise e
+        for start in range(0, len(vm_resources), chunk_size):
+            chunk = vm_resources[start:start + chunk_size]
+            yield self._build_vms(chunk, self._fetch_vms(chunk))
+
+    def _get_vm_resources(self):
+        return self.proxmox.cluster.resources.get(type="vm")
+
+    def _fetch_vms(self, vm_resources):
+        # Results come back in the same order as vm_resources, regardless
+        # of the order in which the workers finish
+        return self._map_per_node(self._fetch_vm, vm_resources)
+
+    def _build_vms(self, vm_resources, fetched):
+        vms = []
+        for vm, result in zip(vm_resources, fetched):
+            if result is None:
+                continue
+            vm_config, current_state, agent_interfaces = result
+
+            # Ensure name exists
+            if "name" not in vm_config:
+                vm_config["name"] = vm.get("name", str(vm.get("vmid")))
+
+            # Use status from current_state if available, else fallback to resource list
+            status = current_state.get("status", vm.get("status", "unknown"))
+            
+            vm_config["tags"] = [] if vm.get("tags") is None else str(vm.get("tags", "")).split(';')
+            vm_config["maxdisk"] = int(vm.get("maxdisk", 0))
+            vm_config["maxcpu"] = int(vm.get("maxcpu", 0))
+            vm_config["vmid"] = vm.get("vmid")
+            vm_config["node"] = vm.get("node")
+            vm_config["status"] = status
+            
+            if is_debug():
+                logger.info(f"VM {vm_config.get('name')} ({vm.get('vmid')}) - Raw Status: {status}")
+            
+            vms.append(VMSnapshot(
+                config=vm_config,
+                interfaces=self._build_vminterfaces(vm_config, agent_interfaces),
+            ))
+        return vms
+
+    def _fetch_vm(self, vm):
+        """Fetch config, current status and agent interfaces of a single VM.
+
+        Returns None if the VM could not be read at all."""
+        qemu = self.proxmox.nodes(vm['node']).qemu(vm['vmid'])
+        try:
+            vm_config = qemu.config.get()
+            if self._needs_status_check(vm, vm_config):
+                # Fetch authoritative status
+                current_state = qemu.status.current.get()
+            else:
+                current_state = self._resource_state(vm)
+        except Exception as e:
+            logger.warning(f"Failed to retrieve config/status for VM {vm.get('vmid')} on node {vm.get('node')}: {e}")
+            return None
+
+        name = vm_config.get("name", vm.get("name", vm.get("vmid")))
+
+        # Try to get agent network info
+        agent_interfaces = []
+        try:
+            if self._should_query_agent(vm_config, current_state):
+                agent_interfaces = self._cached_agent_interfaces(vm, lambda: self._fetch_agent_interfaces(qemu))
+                if is_debug():
+                    logger.info(f"VM {name} - Agent Interfaces: {len(agent_interfaces)} found")
+        except Exception as e:
+            # Agent might not be running or installed, or QEMU agent not enabled
+            if is_debug():
+                logger.info(f"VM {name} - Agent check failed: {e}")
+
+        return vm_config, current_state, agent_interfaces
+
+    def _fetch_agent_interfaces(self, qemu):
+        agent_info = qemu.agent('network-get-interfaces').get()
+        if agent_info and 'result' in agent_info:
+            return agent_info['result']
+        return []
 
-    def _add_vminterfaces(self, vm_config, agent_interfaces=[]):
+    def _cached_agent_interfaces(self, vm, fetch):
+        if self.agent_cache is None:
+            return fetch()
+        vmid = vm['vmid']
+        cached = self.agent_cache.get(vmid)
+        if cached is AgentCache.MISSING:
+            return self.agent_cache.fetch(vmid, fetch)
+        if self.agent_cache.needs_refresh(vmid):
+            self.agent_cache.refresh_in_background(vmid, fetch)
+        return cached
+
+    def _needs_status_check(self, vm, vm_config):
+        if not self.trust_resources:
+            return True
+        # The resources listing can lag behind a VM that was just stopped, so
+        # confirm it before waiting on an agent that is not there
+        return vm.get("status") == "running" and self._agent_enabled(vm_config)
+
+    def _resource_state(self, vm):
+        return {"status": vm.get("status", "unknown")}
+
+    def _should_query_agent(self, vm_config, current_state):
+        # Only try if VM is running
+        if current_state.get("status") != "running":
+            return False
+        return not self.trust_resources or self._agent_enabled(vm_config)
+
+    def _agent_enabled(self, vm_config):
+        # Format: "[enabled=]<0|1>[,fstrim_cloned_disks=<0|1>][,type=<virtio|isa>]"
+        for option in str(vm_config.get("agent", "0")).split(','):
+            key, _, value = option.rpartition('=')
+            if key in ('', 'enabled'):
+                return value.strip() == '1'
+        return False
+
+    def _map_per_node(self, func, items):
+        """Run func over items with a bounded worker pool, limiting how many
+        requests may be in flight against a single node at once.
+
+        Returns the results in the order of items."""
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+
+        node_limits = {
+            node: threading.BoundedSemaphore(self._node_max_workers(node))
+            for node in set(item.get('node') for item in items)
+        }
+
+        def run(item):
+            with node_limits[item.get('node')]:
+                return func(item)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(run, items))
+
+    def _node_max_workers(self, node):
+        limit = self.node_max_workers.get(node, self.max_workers_per_node)
+        return max(1, int(limit))
+
+    def _build_vminterfaces(self, vm_config, agent_interfaces=[]):
+        vminterfaces = []
+        ips_by_mac = index_agent_ips(agent_interfaces)
         for key in vm_config:
-            if key.startswith('net'):
-                # Extract MAC from config string (e.g., virtio=AA:BB:CC:DD:EE:FF,...)
-                mac_match = re.search(r"([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})", vm_config[key])
-                mac_address = mac_match.group(0).upper() if mac_match else None
-                
-                ips = []
-                if mac_address and agent_interfaces:
-                    for iface in agent_interfaces:
-                        if iface.get('hardware-address', '').upper() == mac_address:
-                            for ip_info in iface.get('ip-addresses', []):
-                                ip_addr = ip_info.get('ip-address')
-                                if ip_addr and not ip_addr.startswith('fe80::') and not ip_addr.startswith('127.'):
-                                    # Include CIDR if available, otherwise just IP
-                                    prefix = ip_info.get('prefix')
-                                    if prefix:
-                                        ips.append(f"{ip_addr}/{prefix}")
-                                    else:
-                                        ips.append(ip_addr)
-                
-                if is_debug() and ips:
-                    logger.info(f"VM {vm_config.get('name')} - Interface {key} - IPs found: {ips}")
-
-                # Extract Bridge
-                bridge_match = re.search(r"bridge=([a-zA-Z0-9]+)", vm_config[key])
-                bridge = bridge_match.group(1) if bridge_match else None
-
-                self.vminterfaces.append({
-                    "vm": vm_config["name"],
-                    "node": vm_config.get("node"),
-                    "name": f"{vm_config['name']}:{key}",
-                    "info": vm_config[key],
-                    "ips": ips,
-                    "bridge": bridge
-                })
+            net_key = NET_KEY_RE.match(key)
+            if not net_key:
+                continue
+            nic = parse_net_config(vm_config[key])
+            ips = ips_by_mac.get(nic.mac_address, []) if nic.mac_address else []
+            
+            if is_debug() and ips:
+                logger.info(f"VM {vm_config.get('name')} - Interface {key} - IPs found: {ips}")
+
+            vminterfaces.append({
+                "vm": vm_config["name"],
+                "node": vm_config.get("node"),
+                "name": f"{vm_config['name']}:{key}",
+                "vmid": vm_config.get("vmid"),
+                "net_index": int(net_key.group(1)),
+                "info": vm_config[key],
+                "nic": nic,
+                "ips": ips,
+                "bridge": nic.bridge
+            })
+        return vminterfaces
 
     def get_vminterfaces(self):
-        if len(self.vminterfaces) == 0:
-            self.get_vms()
+        # Interfaces of the last get_vms() call; use get_snapshot() to read
+        # VMs and interfaces together
         return self.vminterfaces
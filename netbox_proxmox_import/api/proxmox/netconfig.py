@@ -0,0 +1,95 @@
+import re
+from typing import NamedTuple, Optional
+
+# Keys of the VM config holding network devices (net0, net1, ...)
+NET_KEY_RE = re.compile(r"^net(\d+)$")
+# One "key=value" option of a netX string
+_OPTION_RE = re.compile(r"([^=,\s]+)=([^,]*)")
+_MAC_RE = re.compile(r"^(?:[0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}$")
+
+
+class NetConfig(NamedTuple):
+    """A parsed netX config string, e.g.
+    'virtio=AA:BB:CC:DD:EE:FF,bridge=vmbr0,firewall=1,tag=20,rate=12.5,queues=4'."""
+
+    model: Optional[str] = None
+    mac_address: Optional[str] = None
+    bridge: Optional[str] = None
+    tag: Optional[int] = None
+    firewall: bool = False
+    rate: Optional[float] = None
+    queues: Optional[int] = None
+    mtu: Optional[int] = None
+    trunks: Optional[str] = None
+    link_down: bool = False
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_mac(mac):
+    return mac.replace('-', ':').upper() if mac else None
+
+
+def parse_net_config(value):
+    options = {}
+    model = None
+    mac_address = None
+    for key, option in _OPTION_RE.findall(value or ""):
+        option = option.strip()
+        # The model is the key whose value is the MAC ("virtio=AA:BB:..."),
+        # older configs may spell it out as "model=virtio,macaddr=AA:BB:..."
+        if model is None and key != "macaddr" and _MAC_RE.match(option):
+            model = key
+            mac_address = option
+        else:
+            options[key] = option
+
+    if mac_address is None and _MAC_RE.match(options.get("macaddr", "")):
+        mac_address = options["macaddr"]
+    if model is None:
+        model = options.get("model")
+
+    return NetConfig(
+        model=model,
+        mac_address=normalize_mac(mac_address),
+        bridge=options.get("bridge") or None,
+        tag=_int(options.get("tag")),
+        firewall=options.get("firewall") == "1",
+        rate=_float(options.get("rate")),
+        queues=_int(options.get("queues")),
+        mtu=_int(options.get("mtu")),
+        trunks=options.get("trunks") or None,
+        link_down=options.get("link_down") == "1",
+    )
+
+
+def index_agent_ips(agent_interfaces):
+    """Map the MAC of each guest agent interface to its usable IP addresses."""
+    ips_by_mac = {}
+    for iface in agent_interfaces or []:
+        mac_address = normalize_mac(iface.get('hardware-address'))
+        if not mac_address:
+            continue
+        ips = ips_by_mac.setdefault(mac_address, [])
+        for ip_info in iface.get('ip-addresses', []):
+            ip_addr = ip_info.get('ip-address')
+            if ip_addr and not ip_addr.startswith('fe80::') and not ip_addr.startswith('127.'):
+                # Include CIDR if available, otherwise just IP
+                prefix = ip_info.get('prefix')
+                if prefix:
+                    ips.append(f"{ip_addr}/{prefix}")
+                else:
+                    ips.append(ip_addr)
+    return ips_by_mac
@@ -0,0 +1,81 @@
+import logging
+import threading
+
+from ..config import get_plugin_setting
+from .connector import Proxmox
+
+logger = logging.getLogger(__name__)
+
+# ProxmoxConnection pk -> (credentials fingerprint, connector)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_connector_class():
+    backend = get_plugin_setting('connector_backend', 'proxmoxer')
+    if backend == 'asyncio':
+        from .async_connector import AsyncProxmox
+        return AsyncProxmox
+    if backend != 'proxmoxer':
+        logger.warning(f"Unknown connector_backend '{backend}', falling back to 'proxmoxer'")
+    return Proxmox
+
+
+def connection_config(proxmox_connection):
+    return {
+        "host": proxmox_connection.domain,
+        "port": proxmox_connection.port,
+        "user": proxmox_connection.user,
+        "token": {
+            "name": proxmox_connection.token_id,
+            "value": proxmox_connection.token_secret,
+        },
+        "verify_ssl": proxmox_connection.verify_ssl,
+        "cache_key": proxmox_connection.pk,
+    }
+
+
+def _fingerprint(proxmox_connection, connector_class):
+    return (
+        connector_class,
+        proxmox_connection.domain,
+        proxmox_connection.port,
+        proxmox_connection.user,
+        proxmox_connection.token_id,
+        proxmox_connection.token_secret,
+        proxmox_connection.verify_ssl,
+    )
+
+
+def get_client(proxmox_connection):
+    """
+    Return the connector of a ProxmoxConnection, reusing the one (and its warm
+    HTTP sessions) built by an earlier sync in this process. A new connector is
+    built whenever the connection's credentials or the backend changed.
+    """
+    connector_class = get_connector_class()
+    fingerprint = _fingerprint(proxmox_connection, connector_class)
+    with _clients_lock:
+        entry = _clients.get(proxmox_connection.pk)
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+        client = connector_class(connection_config(proxmox_connection))
+        _clients[proxmox_connection.pk] = (fingerprint, client)
+    if entry is not None:
+        _close(entry[1])
+    return client
+
+
+def invalidate_client(connection_id):
+    with _clients_lock:
+        entry = _clients.pop(connection_id, None)
+    if entry is not None:
+        _close(entry[1])
+
+
+def _close(client):
+    try:
+        with client.lock:
+            client.close()
+    except Exception as e:
+        logger.warning(f"Failed to close Proxmox connector: {e}")
@@ -0,0 +1,37 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+
+@dataclass
+class VMSnapshot:
+    """A VM as read from Proxmox: its config (with the fields taken from the
+    resources listing merged in) and the interfaces built from its netX keys."""
+
+    config: dict
+    interfaces: List[dict] = field(default_factory=list)
+
+    @property
+    def vmid(self):
+        return self.config.get("vmid")
+
+    @property
+    def name(self):
+        return self.config.get("name")
+
+
+@dataclass
+class ClusterSnapshot:
+    """Everything a sync reads from one Proxmox cluster, fetched in one pass.
+
+    A partial snapshot only holds some of the nodes and VMs; present_vmids
+    then lists every VMID that still exists in the cluster."""
+
+    cluster: dict
+    tags: Dict[str, Optional[str]]
+    nodes: List[dict]
+    vms: List[VMSnapshot]
+    present_vmids: Optional[Set[int]] = None
+
+    @property
+    def vminterfaces(self):
+        return [interface for vm in self.vms for interface in vm.interfaces]
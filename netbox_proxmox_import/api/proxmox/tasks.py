@@ -0,0 +1,47 @@
+from dataclasses import dataclass, field
+from typing import Optional, Set
+
+
+@dataclass
+class TaskChanges:
+    """What the cluster task log says changed since a watermark: the VMs and
+    nodes touched by a task, and the watermark to continue from next time.
+
+    rolled_over means the log no longer reaches back to the old watermark (or
+    there was none), so tasks may be missing and only a full sync is safe."""
+
+    watermark: Optional[int]
+    vmids: Set[int] = field(default_factory=set)
+    nodes: Set[str] = field(default_factory=set)
+    rolled_over: bool = False
+
+
+def changes_since(tasks, since):
+    """Summarize the entries of /cluster/tasks started at or after since."""
+    starttimes = [int(task["starttime"]) for task in tasks if task.get("starttime") is not None]
+    if not starttimes:
+        return TaskChanges(watermark=since, rolled_over=since is None)
+
+    # A task still running when it is read is read again next time, so its
+    # outcome (a finished migration, a VM that started) is not missed
+    running = [
+        int(task["starttime"]) for task in tasks
+        if task.get("starttime") is not None and task.get("endtime") is None
+    ]
+    watermark = min(running) if running else max(starttimes)
+
+    if since is None or min(starttimes) > since:
+        return TaskChanges(watermark=watermark, rolled_over=True)
+
+    changes = TaskChanges(watermark=watermark)
+    for task in tasks:
+        if task.get("starttime") is None or int(task["starttime"]) < since:
+            continue
+        # VM tasks carry the VMID as their id, node tasks (network reloads,
+        # service restarts, ...) something else
+        task_id = str(task.get("id", ""))
+        if task_id.isdigit():
+            changes.vmids.add(int(task_id))
+        elif task.get("node"):
+            changes.nodes.add(task["node"])
+    return changes
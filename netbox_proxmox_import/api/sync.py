@@ -1,14 +1,18 @@
 import json
 
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 from extras.models import CustomField
 from virtualization.models import VirtualMachine
 
 
-from .proxmox.connector import Proxmox
+from .config import get_plugin_setting
+from .proxmox.registry import get_client
 from .netbox.parser import NetBoxParser
 from .netbox.categorizer import NetBoxCategorizer
 from .netbox.updater import NetBoxUpdater
+from .netbox.database import get_read_database
+from .netbox.indexes import DeviceIndex, VLANIndex
 from .. import models
 
 import time
@@ -35,29 +39,33 @@ def sync_cluster(connection_id):
     logger.info(f"Starting sync for cluster {connection_id}")
 
     try:
-        # silently try to create or update the VMID custom field
-        vm_contenttype = ContentType.objects.get(app_label="virtualization", model="virtualmachine")
-        vmid, created = CustomField.objects.update_or_create(
-            name="vmid",
-            defaults={
-                "label": "[Proxmox] VM ID",
-                "description": "[Proxmox] VM ID",
-                "type": "integer",
-                # "object_types": [vm_contenttype.id],
-                "required": True,
-            }
-        )
-        vmid.object_types.set([vm_contenttype.id])
+        ensure_vmid_custom_field()
 
         proxmox_connection = models.ProxmoxConnection.objects.get(pk=connection_id)
-        proxmox_data = get_proxmox_data(proxmox_connection)
-        parsed_data = parse_proxmox_data(proxmox_connection, proxmox_data)
-        categorized_data = categorize_operations(proxmox_connection, parsed_data)
-        returned = update_netbox(proxmox_connection, categorized_data)
-        
-        # Update Nodes separately
-        updater = NetBoxUpdater(proxmox_connection)
-        updater.update_nodes(categorized_data["nodes"])
+        sync_state = None
+        changes = None
+        if get_plugin_setting('incremental', False):
+            sync_state, _ = models.ProxmoxSyncState.objects.get_or_create(connection=proxmox_connection)
+            changes = get_task_changes(proxmox_connection, sync_state)
+
+        full_sync = changes is None or needs_full_sync(sync_state, changes)
+        if not full_sync:
+            returned = sync_incremental(proxmox_connection, changes)
+        elif get_plugin_setting('streaming', False):
+            returned = stream_netbox(proxmox_connection, int(get_plugin_setting('stream_chunk_size', 250)))
+        else:
+            snapshot = get_proxmox_data(proxmox_connection)
+            parsed_data = parse_proxmox_data(proxmox_connection, snapshot)
+            # Device names and VLANs are loaded once and shared by both phases
+            using = get_read_database()
+            device_index = DeviceIndex(proxmox_connection.cluster, using)
+            vlan_index = VLANIndex(proxmox_connection.cluster, using)
+            categorized_data = categorize_operations(proxmox_connection, parsed_data, device_index, vlan_index, using)
+            record_tag_ownership(proxmox_connection, [tag.name for tag in parsed_data["tags"]])
+            returned = update_netbox(proxmox_connection, categorized_data, device_index, vlan_index)
+
+        if sync_state is not None:
+            record_sync_state(sync_state, changes, full_sync)
 
         end = time.time()
         elapsed = end - start
@@ -72,36 +80,106 @@ def sync_cluster(connection_id):
         raise e
 
 
-def get_proxmox_data(proxmox_connection):
-    px = Proxmox({
-        "host": proxmox_connection.domain,
-        "port": proxmox_connection.port,
-        "user": proxmox_connection.user,
-        "token": {
-            "name": proxmox_connection.token_id,
-            "value": proxmox_connection.token_secret,
-        },
-        "verify_ssl": proxmox_connection.verify_ssl,
-    })
-    return {
-        "cluster": px.get_cluster(),
-        "tags": px.get_tags(),
-        "nodes": px.get_nodes(),
-        "vms": px.get_vms(),
-        "vminterfaces": px.get_vminterfaces(),
+def get_task_changes(proxmox_connection, sync_state):
+    """Read the cluster task log, or return None if it cannot be read."""
+    px = get_client(proxmox_connection)
+    try:
+        with px.lock:
+            return px.get_task_changes(sync_state.task_watermark)
+    except Exception as e:
+        logger.warning(f"Failed to read the task log of {proxmox_connection}, doing a full sync: {e}")
+        return None
+
+def needs_full_sync(sync_state, changes):
+    if changes.rolled_over or sync_state.last_full_sync is None:
+        return True
+    interval = int(get_plugin_setting('full_sync_interval', 86400) or 0)
+    if interval <= 0:
+        return False
+    return (timezone.now() - sync_state.last_full_sync).total_seconds() >= interval
+
+def record_sync_state(sync_state, changes, full):
+    now = timezone.now()
+    # Without a readable task log the old watermark is kept: once it falls
+    # out of the log the next sync sees the log as rolled over
+    if changes is not None:
+        sync_state.task_watermark = changes.watermark
+    sync_state.last_sync = now
+    if full:
+        sync_state.last_full_sync = now
+    # Not tags_recorded, which record_tag_ownership() has set in the meantime
+    sync_state.save(update_fields=['task_watermark', 'last_sync', 'last_full_sync'])
+
+def sync_incremental(connection, changes):
+    """
+    Re-read and update only the VMs and nodes that a task touched since the
+    last sync, plus VMs that are not in NetBox yet. VMs that were not re-read
+    are kept as they are, and VMs no longer in Proxmox are deleted.
+    """
+    px = get_client(connection)
+    known_vmids = set(models.ProxmoxVMMapping.objects.filter(connection=connection).values_list("vmid", flat=True))
+    with px.lock:
+        snapshot = px.get_partial_snapshot(changes.vmids, changes.nodes, known_vmids)
+    parsed_data = parse_proxmox_data(connection, snapshot)
+
+    using = get_read_database()
+    device_index = DeviceIndex(connection.cluster, using)
+    vlan_index = VLANIndex(connection.cluster, using)
+    categorizer = NetBoxCategorizer(connection, device_index, vlan_index, using)
+
+    unread_vmids = snapshot.present_vmids - set(vm.vmid for vm in snapshot.vms)
+    categorizer.begin_vms()
+    categorized_vms = categorizer.categorize_vms_chunk(parsed_data["vms"])
+    kept_vm_ids = categorizer.keep_vms(unread_vmids)
+    categorized_vms["delete"] = categorizer.finish_vms()
+
+    categorizer.begin_vminterfaces()
+    categorized_vminterfaces = categorizer.categorize_vminterfaces_chunk(parsed_data["vminterfaces"])
+    categorizer.keep_vminterfaces(kept_vm_ids)
+    categorized_vminterfaces["delete"] = categorizer.finish_vminterfaces()
+
+    categorized_data = {
+        "tags": categorizer.categorize_tags(parsed_data["tags"]),
+        "nodes": categorizer.categorize_nodes(parsed_data["nodes"]),
+        "vms": categorized_vms,
+        "vminterfaces": categorized_vminterfaces,
+    }
+    record_tag_ownership(connection, [tag.name for tag in parsed_data["tags"]])
+    returned = update_netbox(connection, categorized_data, device_index, vlan_index)
+    returned["incremental"] = {
+        "vms": len(snapshot.vms),
+        "nodes": len(snapshot.nodes),
     }
+    return returned
+
+def ensure_vmid_custom_field():
+    """Create the VMID custom field, unless it already exists on VirtualMachine."""
+    vm_contenttype = ContentType.objects.get(app_label="virtualization", model="virtualmachine")
+    if CustomField.objects.filter(name="vmid", object_types=vm_contenttype).exists():
+        return
+    vmid, created = CustomField.objects.update_or_create(
+        name="vmid",
+        defaults={
+            "label": "[Proxmox] VM ID",
+            "description": "[Proxmox] VM ID",
+            "type": "integer",
+            # "object_types": [vm_contenttype.id],
+            "required": True,
+        }
+    )
+    vmid.object_types.set([vm_contenttype.id])
 
-def parse_proxmox_data(connection, proxmox_data):
+def get_proxmox_data(proxmox_connection):
+    px = get_client(proxmox_connection)
+    with px.lock:
+        return px.get_snapshot()
+
+def parse_proxmox_data(connection, snapshot):
     nb = NetBoxParser(connection)
-    return {
-        "tags": nb.parse_tags(proxmox_data["tags"]),
-        "nodes": nb.parse_nodes(proxmox_data["nodes"]),
-        "vms": nb.parse_vms(proxmox_data["vms"]),
-        "vminterfaces": nb.parse_vminterfaces(proxmox_data["vminterfaces"]),
-    }
+    return nb.parse_snapshot(snapshot)
 
-def categorize_operations(connection, parsed_data):
-    nb = NetBoxCategorizer(connection)
+def categorize_operations(connection, parsed_data, device_index=None, vlan_index=None, using=None):
+    nb = NetBoxCategorizer(connection, device_index, vlan_index, using)
     return {
         "tags": nb.categorize_tags(parsed_data["tags"]),
         "nodes": nb.categorize_nodes(parsed_data["nodes"]),
@@ -109,36 +187,129 @@ def categorize_operations(connection, parsed_data):
         "vminterfaces": nb.categorize_vminterfaces(parsed_data["vminterfaces"]),
     }
 
-def update_netbox(connection, categorized_data):
-    nb = NetBoxUpdater(connection)
+def record_tag_ownership(connection, tag_names):
+    """Remember which tags the cluster of this connection uses."""
+    tag_names = set(tag_names)
+    owned = models.ProxmoxTagOwnership.objects.filter(connection=connection)
+    owned.exclude(name__in=tag_names).delete()
+    known = set(owned.values_list("name", flat=True))
+    owned.filter(name__in=known).update(last_seen=timezone.now())
+    models.ProxmoxTagOwnership.objects.bulk_create([
+        models.ProxmoxTagOwnership(connection=connection, name=name)
+        for name in tag_names - known
+    ])
+    # Also when there are no tags, so other syncs know there is nothing to ask for
+    models.ProxmoxSyncState.objects.update_or_create(
+        connection=connection, defaults={"tags_recorded": timezone.now()}
+    )
 
-    # Do not delete tags that are in use by other clusters (janky for now, but works)
-    other_clusters = models.ProxmoxConnection.objects.exclude(pk=connection.id)
-    nodelete_tagnames = set()
-    for cluster in other_clusters:
+def get_nodelete_tagnames(connection):
+    """Names of the tags in use by the clusters of all other connections."""
+    nodelete_tagnames = set(
+        models.ProxmoxTagOwnership.objects.exclude(connection=connection).values_list("name", flat=True)
+    )
+
+    # Only connections whose tags were never recorded (not synced since tag
+    # ownership is recorded) still have to be asked directly. Entries without
+    # tags_recorded were written before it existed.
+    unrecorded = models.ProxmoxConnection.objects.exclude(pk=connection.pk).filter(
+        sync_state__tags_recorded__isnull=True, tag_ownerships__isnull=True
+    )
+    for cluster in unrecorded:
         try:
-            other_px = Proxmox({
-                "host": cluster.domain,
-                "port": cluster.port,
-                "user": cluster.user,
-                "token": {
-                    "name": cluster.token_id,
-                    "value": cluster.token_secret,
-                },
-                "verify_ssl": cluster.verify_ssl,
-            })
-            other_tags = other_px.get_tags()
-            for tag in other_tags.keys():
-                nodelete_tagnames.add(tag)
+            other_px = get_client(cluster)
+            with other_px.lock:
+                other_tags = other_px.get_tags()
+            nodelete_tagnames.update(other_tags.keys())
         except:
             # Yeah... fail silently...
             # If you can't connect to the cluster there's no way to know which tags not to delete
             # Just because another connection failed it does not mean this one has to
             pass
 
+    return nodelete_tagnames
+
+def update_netbox(connection, categorized_data, device_index=None, vlan_index=None):
+    nb = NetBoxUpdater(connection, device_index, vlan_index)
 
+    # Do not delete tags that are in use by other clusters
+    nodelete_tagnames = get_nodelete_tagnames(connection)
+
+    # Nodes go first: VMs can be assigned to new nodes, and the VM interface
+    # topology reuses the node interfaces they loaded
     return {
         "tags": nb.update_tags(categorized_data["tags"], nodelete_tagnames),
+        "nodes": nb.update_nodes(categorized_data["nodes"]),
         "vms": nb.update_vms(categorized_data["vms"]),
         "vminterfaces": nb.update_vminterfaces(categorized_data["vminterfaces"]),
     }
+
+def stream_netbox(connection, chunk_size):
+    """
+    Fetch, parse, categorize and update the VMs of a cluster chunk_size VMs at
+    a time, so the memory used stays bounded no matter how big the cluster is.
+    VMs and interfaces that were not seen in any chunk are deleted at the end.
+    """
+    px = get_client(connection)
+    parser = NetBoxParser(connection)
+    using = get_read_database()
+    device_index = DeviceIndex(connection.cluster, using)
+    vlan_index = VLANIndex(connection.cluster, using)
+    categorizer = NetBoxCategorizer(connection, device_index, vlan_index, using)
+    updater = NetBoxUpdater(connection, device_index, vlan_index)
+
+    with px.lock:
+        px.get_cluster()
+        parsed_tags = parser.parse_tags(px.get_tags())
+        parsed_nodes = parser.parse_nodes(px.get_nodes())
+
+        categorized_tags = categorizer.categorize_tags(parsed_tags)
+        categorized_nodes = categorizer.categorize_nodes(parsed_nodes)
+        record_tag_ownership(connection, [tag.name for tag in parsed_tags])
+        returned = {
+            "tags": updater.update_tags(categorized_tags, get_nodelete_tagnames(connection)),
+            "nodes": updater.update_nodes(categorized_nodes),
+            "vms": None,
+            "vminterfaces": None,
+        }
+
+        categorizer.begin_vms()
+        categorizer.begin_vminterfaces()
+        for vm_snapshots in px.iter_vm_chunks(chunk_size):
+            px_vms = [vm.config for vm in vm_snapshots]
+            px_vminterfaces = [interface for vm in vm_snapshots for interface in vm.interfaces]
+            categorized_vms = categorizer.categorize_vms_chunk(parser.iter_vms(px_vms))
+            returned["vms"] = merge_results(returned["vms"], updater.update_vms(categorized_vms))
+
+            categorized_vminterfaces = categorizer.categorize_vminterfaces_chunk(parser.iter_vminterfaces(px_vminterfaces))
+            returned["vminterfaces"] = merge_results(
+                returned["vminterfaces"], updater.update_vminterfaces(categorized_vminterfaces)
+            )
+
+    returned["vms"] = merge_results(returned["vms"], updater.update_vms({
+        "create": [],
+        "update": [],
+        "delete": categorizer.finish_vms(),
+        "warnings": list(categorizer.vm_warnings),
+        "fingerprints": categorizer.vm_fingerprints,
+    }))
+    returned["vminterfaces"] = merge_results(returned["vminterfaces"], updater.update_vminterfaces({
+        "create": [],
+        "update": [],
+        "delete": categorizer.finish_vminterfaces(),
+        "warnings": list(categorizer.vminterface_warnings),
+        "fingerprints": categorizer.vminterface_fingerprints,
+    }))
+
+    return returned
+
+def merge_results(total, part):
+    if total is None:
+        return part
+    for key in ("created", "updated", "deleted", "errors"):
+        total[key].extend(part[key])
+    if "cables" in part:
+        for key, count in part["cables"].items():
+            total["cables"][key] = total["cables"].get(key, 0) + count
+    total["warnings"] = part["warnings"]
+    return total
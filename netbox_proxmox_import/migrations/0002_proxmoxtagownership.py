@@ -0,0 +1,24 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_proxmox_import', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProxmoxTagOwnership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=100)),
+                ('last_seen', models.DateTimeField(auto_now=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_ownerships', to='netbox_proxmox_import.proxmoxconnection')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('connection', 'name'), name='netbox_proxmox_import_tagownership_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_proxmox_import', '0002_proxmoxtagownership'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProxmoxObjectFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('vm', 'Virtual Machine'), ('vminterface', 'VM Interface')], max_length=20)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('reconciled', models.DateTimeField()),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprints', to='netbox_proxmox_import.proxmoxconnection')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('connection', 'kind', 'object_id'), name='netbox_proxmox_import_fingerprint_unique')],
+            },
+        ),
+    ]
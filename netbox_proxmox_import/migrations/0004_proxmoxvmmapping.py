@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('virtualization', '0040_convert_disk_size'),
+        ('netbox_proxmox_import', '0003_proxmoxobjectfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProxmoxVMMapping',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('node', models.CharField(blank=True, max_length=255)),
+                ('vmid', models.PositiveIntegerField()),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vm_mappings', to='netbox_proxmox_import.proxmoxconnection')),
+                ('virtual_machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='virtualization.virtualmachine')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('connection', 'vmid'), name='netbox_proxmox_import_vmmapping_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('virtualization', '0040_convert_disk_size'),
+        ('netbox_proxmox_import', '0004_proxmoxvmmapping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProxmoxVMInterfaceMapping',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('vmid', models.PositiveIntegerField()),
+                ('net_index', models.PositiveSmallIntegerField()),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vminterface_mappings', to='netbox_proxmox_import.proxmoxconnection')),
+                ('vminterface', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='virtualization.vminterface')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('connection', 'vmid', 'net_index'), name='netbox_proxmox_import_vminterfacemapping_unique')],
+            },
+        ),
+    ]
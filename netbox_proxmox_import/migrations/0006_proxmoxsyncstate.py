@@ -0,0 +1,22 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_proxmox_import', '0005_proxmoxvminterfacemapping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProxmoxSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('task_watermark', models.BigIntegerField(blank=True, null=True)),
+                ('last_sync', models.DateTimeField(blank=True, null=True)),
+                ('last_full_sync', models.DateTimeField(blank=True, null=True)),
+                ('connection', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='netbox_proxmox_import.proxmoxconnection')),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_proxmox_import', '0006_proxmoxsyncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proxmoxsyncstate',
+            name='tags_recorded',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -32,3 +32,126 @@ class ProxmoxConnection(NetBoxModel):
         on_delete=models.CASCADE,
         related_name='connections'
     )
+
+
+class ProxmoxTagOwnership(Model):
+    """Records which connection last saw a Proxmox tag, so a sync knows which
+    tags belong to other clusters without asking their Proxmox APIs."""
+
+    connection = models.ForeignKey(
+        to=ProxmoxConnection,
+        on_delete=models.CASCADE,
+        related_name='tag_ownerships'
+    )
+    name = models.CharField(max_length=100)
+    last_seen = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('connection', 'name'), name='netbox_proxmox_import_tagownership_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.connection})'
+
+
+class ProxmoxObjectFingerprint(Model):
+    """Content hash of the Proxmox data a NetBox object was last synced from,
+    so unchanged objects can be skipped without comparing them field by field."""
+
+    KIND_VM = 'vm'
+    KIND_VMINTERFACE = 'vminterface'
+    KIND_CHOICES = (
+        (KIND_VM, 'Virtual Machine'),
+        (KIND_VMINTERFACE, 'VM Interface'),
+    )
+
+    connection = models.ForeignKey(
+        to=ProxmoxConnection,
+        on_delete=models.CASCADE,
+        related_name='fingerprints'
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    fingerprint = models.CharField(max_length=64)
+    reconciled = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('connection', 'kind', 'object_id'), name='netbox_proxmox_import_fingerprint_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id} ({self.connection})'
+
+
+class ProxmoxVMMapping(Model):
+    """Which VirtualMachine a Proxmox VMID of a connection was synced to."""
+
+    connection = models.ForeignKey(
+        to=ProxmoxConnection,
+        on_delete=models.CASCADE,
+        related_name='vm_mappings'
+    )
+    node = models.CharField(max_length=255, blank=True)
+    vmid = models.PositiveIntegerField()
+    virtual_machine = models.ForeignKey(
+        to='virtualization.virtualmachine',
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('connection', 'vmid'), name='netbox_proxmox_import_vmmapping_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.vmid} -> {self.virtual_machine_id} ({self.connection})'
+
+
+class ProxmoxVMInterfaceMapping(Model):
+    """Which VMInterface the netN device of a Proxmox VM was synced to, so
+    interfaces keep their identity across VM renames and MAC changes."""
+
+    connection = models.ForeignKey(
+        to=ProxmoxConnection,
+        on_delete=models.CASCADE,
+        related_name='vminterface_mappings'
+    )
+    vmid = models.PositiveIntegerField()
+    net_index = models.PositiveSmallIntegerField()
+    vminterface = models.ForeignKey(
+        to='virtualization.vminterface',
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('connection', 'vmid', 'net_index'), name='netbox_proxmox_import_vminterfacemapping_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.vmid}:net{self.net_index} -> {self.vminterface_id} ({self.connection})'
+
+
+class ProxmoxSyncState(Model):
+    """Where the last successful sync of a connection left off in the Proxmox
+    cluster task log, so the next one only has to re-read what changed."""
+
+    connection = models.OneToOneField(
+        to=ProxmoxConnection,
+        on_delete=models.CASCADE,
+        related_name='sync_state'
+    )
+    # Start time (Proxmox epoch seconds) of the newest task already synced
+    task_watermark = models.BigIntegerField(null=True, blank=True)
+    last_sync = models.DateTimeField(null=True, blank=True)
+    last_full_sync = models.DateTimeField(null=True, blank=True)
+    # When the tags of the cluster were last recorded (as ProxmoxTagOwnership,
+    # none if it has no tags), so other syncs need not ask its Proxmox API
+    tags_recorded = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.connection} @ {self.task_watermark}'
@@ -0,0 +1,19 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .api.proxmox.registry import invalidate_client
+from .models import ProxmoxConnection, ProxmoxSyncState
+
+
+@receiver(post_save, sender=ProxmoxConnection)
+@receiver(post_delete, sender=ProxmoxConnection)
+def invalidate_proxmox_client(sender, instance, **kwargs):
+    # Drop the cached connector so the next sync logs in with the new credentials
+    invalidate_client(instance.pk)
+
+
+@receiver(post_save, sender=ProxmoxConnection)
+def reset_sync_state(sender, instance, created, **kwargs):
+    # The task log watermark may belong to another cluster now
+    if not created:
+        ProxmoxSyncState.objects.filter(connection=instance).delete()
@@ -0,0 +1,157 @@
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from dcim.models import Device, DeviceRole, DeviceType, Manufacturer, Site
+from extras.models import Tag
+from virtualization.models import Cluster, ClusterType, VirtualMachine
+
+from netbox_proxmox_import.api.netbox.categorizer import NetBoxCategorizer
+from netbox_proxmox_import.api.netbox.indexes import DeviceIndex, VLANIndex
+from netbox_proxmox_import.api.netbox.records import ParsedVM, ParsedVMInterface
+from netbox_proxmox_import.api.netbox.updater import NetBoxUpdater
+from netbox_proxmox_import.models import ProxmoxConnection, ProxmoxVMMapping
+
+
+class CategorizerTestCase(TestCase):
+    """A cluster with one node, a Proxmox tag and a connection."""
+
+    @classmethod
+    def setUpTestData(cls):
+        site = Site.objects.create(name="Site 1", slug="site-1")
+        cluster_type = ClusterType.objects.create(name="Proxmox", slug="proxmox")
+        cls.cluster = Cluster.objects.create(name="Cluster 1", type=cluster_type)
+        manufacturer = Manufacturer.objects.create(name="Proxmox", slug="proxmox")
+        cls.device = Device.objects.create(
+            name="pve1",
+            device_type=DeviceType.objects.create(model="Proxmox Node", slug="proxmox-node", manufacturer=manufacturer),
+            role=DeviceRole.objects.create(name="Server", slug="server"),
+            site=site,
+            cluster=cls.cluster,
+        )
+        cls.tag = Tag.objects.create(name="web", slug="nbpsync__web")
+        cls.connection = ProxmoxConnection.objects.create(
+            domain="pve.example.com",
+            port=8006,
+            user="netbox@pve",
+            token_id="sync",
+            token_secret="secret",
+            cluster=cls.cluster,
+        )
+
+    def create_vms(self, first_vmid, count):
+        """Create count synced VMs and return their parsed Proxmox records,
+        half of them unchanged and half with a changed VM (to be updated)."""
+        parsed_vms = []
+        for vmid in range(first_vmid, first_vmid + count):
+            vm = VirtualMachine.objects.create(
+                name=f"vm-{vmid}",
+                status="active",
+                device=self.device,
+                cluster=self.cluster,
+                vcpus=2,
+                memory=2048,
+                disk=10240,
+                custom_field_data={"vmid": vmid},
+            )
+            vm.tags.add(self.tag)
+            ProxmoxVMMapping.objects.create(connection=self.connection, vmid=vmid, virtual_machine=vm, node="pve1")
+            parsed_vms.append(ParsedVM(
+                name=vm.name,
+                status="active",
+                device="pve1",
+                vcpus=2 if vmid % 2 else 4,
+                memory=2048,
+                disk=10240,
+                tags=("web",),
+                vmid=vmid,
+            ))
+        return parsed_vms
+
+    def make_categorizer(self):
+        # The indexes are built up front, so queries count only the categorizing
+        return NetBoxCategorizer(
+            self.connection,
+            DeviceIndex(self.cluster),
+            VLANIndex(self.cluster),
+            DEFAULT_DB_ALIAS,
+        )
+
+
+class CategorizeVMsQueryCountTestCase(CategorizerTestCase):
+    """categorize_vms() must read the existing VMs, their devices and tags in
+    a constant number of queries, however many VMs the cluster has."""
+
+    def test_query_count_is_constant(self):
+        count = 10
+        parsed_vms = self.create_vms(100, count)
+        categorizer = self.make_categorizer()
+        with CaptureQueriesContext(connection) as queries:
+            categorized = categorizer.categorize_vms(parsed_vms)
+        self.assertEqual(len(categorized["update"]), count // 2)
+        self.assertEqual(categorized["delete"], [])
+
+        # Twice the VMs, same number of queries
+        parsed_vms += self.create_vms(100 + count, count)
+        categorizer = self.make_categorizer()
+        with self.assertNumQueries(len(queries)):
+            categorized = categorizer.categorize_vms(parsed_vms)
+        self.assertEqual(len(categorized["update"]), count)
+        self.assertEqual(categorized["delete"], [])
+
+
+class StreamingTestCase(CategorizerTestCase):
+    """Chunks are categorized and written one after the other, as in
+    streaming mode; what a chunk creates must not be deleted at the end."""
+
+    def parsed_vm(self, vmid):
+        return ParsedVM(
+            name=f"vm-{vmid}",
+            status="active",
+            device="pve1",
+            vcpus=2,
+            memory=2048,
+            disk=10240,
+            tags=("web",),
+            vmid=vmid,
+        )
+
+    def parsed_vminterface(self, vmid):
+        return ParsedVMInterface(
+            name=f"vm-{vmid}:net0",
+            virtual_machine=f"vm-{vmid}",
+            vmid=vmid,
+            net_index=0,
+            mac_address=None,
+            mode="access",
+            ip_addresses=(),
+            bridge=None,
+            node="pve1",
+            untagged_vid=None,
+        )
+
+    def test_created_vms_are_kept(self):
+        # In NetBox but no longer in Proxmox
+        self.create_vms(100, 1)
+        stale_vm = VirtualMachine.objects.get(name="vm-100")
+
+        categorizer = self.make_categorizer()
+        updater = NetBoxUpdater(self.connection, categorizer.device_index, categorizer.vlan_index)
+        categorizer.begin_vms()
+        categorizer.begin_vminterfaces()
+        for chunk in ([200, 201], [202]):
+            categorized_vms = categorizer.categorize_vms_chunk([self.parsed_vm(vmid) for vmid in chunk])
+            self.assertEqual(len(categorized_vms["create"]), len(chunk))
+            self.assertEqual(updater.update_vms(categorized_vms)["errors"], [])
+
+            categorized_vminterfaces = categorizer.categorize_vminterfaces_chunk(
+                [self.parsed_vminterface(vmid) for vmid in chunk]
+            )
+            self.assertEqual(len(categorized_vminterfaces["create"]), len(chunk))
+            self.assertEqual(updater.update_vminterfaces(categorized_vminterfaces)["errors"], [])
+
+        self.assertEqual([vm.pk for vm in categorizer.finish_vms()], [stale_vm.pk])
+        self.assertEqual(categorizer.finish_vminterfaces(), [])
+        self.assertEqual(
+            VirtualMachine.objects.filter(cluster=self.cluster, name__in=["vm-200", "vm-201", "vm-202"]).count(), 3
+        )
@@ -0,0 +1,131 @@
+import logging
+import os
+import re
+import timeit
+from unittest import skipUnless
+
+from django.test import SimpleTestCase
+
+from netbox_proxmox_import.api.proxmox.netconfig import index_agent_ips, parse_net_config
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_mac_vlan_bridge(net_string):
+    """How a netX string was read before parse_net_config(): separate regex
+    searches in the connector (MAC, bridge) and the parser (MAC, tag)."""
+    mac_match = re.search(r"([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})", net_string)
+    mac_address = mac_match.group(0).upper() if mac_match else None
+    bridge_match = re.search(r"bridge=([a-zA-Z0-9]+)", net_string)
+    bridge = bridge_match.group(1) if bridge_match else None
+    mac_match = re.search(r"([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})", net_string)
+    tag_match = re.search(r"tag=(\d+)", net_string)
+    tag = int(tag_match.group(1)) if tag_match else None
+    return mac_address, bridge, tag
+
+
+def legacy_agent_ips(mac_address, agent_interfaces):
+    """How agent IPs were matched before index_agent_ips(): a scan of all
+    agent interfaces for every netX interface."""
+    ips = []
+    for iface in agent_interfaces:
+        if iface.get('hardware-address', '').upper() == mac_address:
+            for ip_info in iface.get('ip-addresses', []):
+                ip_addr = ip_info.get('ip-address')
+                if ip_addr and not ip_addr.startswith('fe80::') and not ip_addr.startswith('127.'):
+                    prefix = ip_info.get('prefix')
+                    if prefix:
+                        ips.append(f"{ip_addr}/{prefix}")
+                    else:
+                        ips.append(ip_addr)
+    return ips
+
+
+def make_net_strings(count):
+    return [
+        f"virtio=BC:24:11:00:{i // 256:02X}:{i % 256:02X},bridge=vmbr{i % 4},firewall=1,tag={i % 4000 + 1},queues=4"
+        for i in range(count)
+    ]
+
+
+def make_agent_interfaces(count):
+    return [
+        {
+            "name": f"eth{i}",
+            "hardware-address": f"bc:24:11:00:{i // 256:02x}:{i % 256:02x}",
+            "ip-addresses": [
+                {"ip-address": f"10.{i // 256}.{i % 256}.1", "prefix": 24},
+                {"ip-address": f"fe80::{i:x}", "prefix": 64},
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+class NetConfigTestCase(SimpleTestCase):
+
+    def test_parse_net_config(self):
+        nic = parse_net_config("virtio=bc:24:11:aa:bb:cc,bridge=vmbr1,firewall=1,tag=20,rate=12.5,queues=4")
+        self.assertEqual(nic.model, "virtio")
+        self.assertEqual(nic.mac_address, "BC:24:11:AA:BB:CC")
+        self.assertEqual(nic.bridge, "vmbr1")
+        self.assertEqual(nic.tag, 20)
+        self.assertTrue(nic.firewall)
+        self.assertEqual(nic.rate, 12.5)
+        self.assertEqual(nic.queues, 4)
+
+    def test_parse_net_config_macaddr(self):
+        nic = parse_net_config("model=e1000,macaddr=BC-24-11-AA-BB-CC,bridge=vmbr0")
+        self.assertEqual(nic.model, "e1000")
+        self.assertEqual(nic.mac_address, "BC:24:11:AA:BB:CC")
+        self.assertIsNone(nic.tag)
+
+    def test_index_agent_ips(self):
+        ips_by_mac = index_agent_ips(make_agent_interfaces(2))
+        self.assertEqual(ips_by_mac["BC:24:11:00:00:01"], ["10.0.1.1/24"])
+
+    def test_parse_net_config_matches_legacy(self):
+        for net_string in make_net_strings(1000):
+            nic = parse_net_config(net_string)
+            self.assertEqual((nic.mac_address, nic.bridge, nic.tag), legacy_mac_vlan_bridge(net_string))
+
+    def test_index_agent_ips_matches_legacy(self):
+        agent_interfaces = make_agent_interfaces(64)
+        ips_by_mac = index_agent_ips(agent_interfaces)
+        for net_string in make_net_strings(64):
+            mac = parse_net_config(net_string).mac_address
+            self.assertEqual(ips_by_mac.get(mac, []), legacy_agent_ips(mac, agent_interfaces))
+
+
+@skipUnless(os.environ.get("NBPSYNC_BENCHMARK"), "set NBPSYNC_BENCHMARK=1 to run the benchmarks")
+class NetConfigBenchmark(SimpleTestCase):
+    """
+    Micro-benchmark of the netX parser and the MAC-keyed agent index against
+    the regex searches and nested loop they replaced. Wall-clock timings are
+    not reliable enough to assert on, so they are only logged (run with
+    NBPSYNC_BENCHMARK=1 and the netbox_proxmox_import logger at INFO).
+    """
+
+    repeat = 20
+
+    def test_parse_net_config(self):
+        net_strings = make_net_strings(1000)
+        legacy = timeit.timeit(lambda: [legacy_mac_vlan_bridge(s) for s in net_strings], number=self.repeat)
+        current = timeit.timeit(lambda: [parse_net_config(s) for s in net_strings], number=self.repeat)
+        logger.info(f"netX parsing of {len(net_strings)} strings: legacy {legacy:.4f}s, parse_net_config {current:.4f}s")
+
+    def test_index_agent_ips(self):
+        # A VM with many NICs, e.g. a router
+        agent_interfaces = make_agent_interfaces(64)
+        macs = [parse_net_config(s).mac_address for s in make_net_strings(64)]
+
+        def indexed():
+            ips_by_mac = index_agent_ips(agent_interfaces)
+            return [ips_by_mac.get(mac, []) for mac in macs]
+
+        def nested():
+            return [legacy_agent_ips(mac, agent_interfaces) for mac in macs]
+
+        legacy = timeit.timeit(nested, number=self.repeat)
+        current = timeit.timeit(indexed, number=self.repeat)
+        logger.info(f"Agent IPs of {len(macs)} NICs: nested loop {legacy:.4f}s, index_agent_ips {current:.4f}s")